@@ -1,22 +1,243 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import sqlite3, os, time
-from typing import List, Optional, Literal
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from starlette.concurrency import run_in_threadpool
+import numpy as np
+import orjson
+import sqlite3, os, time, queue, threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Iterator, List, Optional, Literal, Union
 
 DB_PATH = os.environ.get("SLA_DB", "sla.sqlite")
+READER_POOL_SIZE = int(os.environ.get("SLA_DB_READERS", "4"))
+# samples older than this (relative to the newest tick) are pruned; 0 keeps all
+SAMPLE_RETENTION = int(os.environ.get("SLA_SAMPLE_RETENTION", str(7 * 86400)))
+SAMPLE_PRUNE_INTERVAL = 3600  # seconds between prune passes
 
-app = FastAPI(title="Meraki SLA API")
+# samples.status / state_changes.sample_bits bit layout
+SAMPLE_GATEWAY = 0b100
+SAMPLE_MX = 0b010
+SAMPLE_IPSEC = 0b001
+
+# bump whenever init() gains new DDL or migrations
+CURRENT_SCHEMA_VERSION = 5
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_pool()
+    try:
+        yield
+    finally:
+        close_pool()
+
+
+app = FastAPI(title="Meraki SLA API", lifespan=lifespan)
+
+# per-connection tuning; journal_mode=WAL is persistent so it is only set once
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+_wal_enabled = False
 
 
 def db():
-    conn = sqlite3.connect(DB_PATH)
+    global _wal_enabled
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    if DB_PATH != ":memory:":
+        if not _wal_enabled:
+            conn.execute("PRAGMA journal_mode=WAL")
+            _wal_enabled = True
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
     return conn
 
 
+# process-wide connections: N readers handed out from a queue, plus a single
+# writer serialized by a lock (SQLite only ever allows one writer anyway)
+_pool: Optional[queue.Queue] = None
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
+_pool_lock = threading.Lock()
+OPTIMIZE_INTERVAL = 3600  # seconds between PRAGMA optimize runs
+_last_optimize: Optional[float] = None  # guarded by _writer_lock
+
+
+def open_pool() -> queue.Queue:
+    global _pool, _writer
+    with _pool_lock:
+        if _pool is None:
+            init()
+            pool: queue.Queue = queue.Queue()
+            for _ in range(max(1, READER_POOL_SIZE)):
+                pool.put(db())
+            _writer = db()
+            with _writer_lock:
+                load_last_states(_writer)
+            _pool = pool
+        return _pool
+
+
+def close_pool():
+    global _pool, _writer
+    with _pool_lock, _writer_lock:
+        if _pool is not None:
+            while not _pool.empty():
+                _pool.get_nowait().close()
+            _pool = None
+        if _writer is not None:
+            _writer.execute("PRAGMA optimize")
+            _writer.close()
+            _writer = None
+
+
+@contextmanager
+def get_conn() -> Iterator[sqlite3.Connection]:
+    """Borrow a reader connection from the pool."""
+    pool = _pool or open_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+@contextmanager
+def get_writer() -> Iterator[sqlite3.Connection]:
+    """Hold the shared writer connection; rolls back on error."""
+    global _last_optimize
+    open_pool()
+    with _writer_lock:
+        conn = _writer
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        # keep planner stats current as tables grow. Pooled connections are
+        # long-lived, so this runs hourly on release rather than on close;
+        # only the writer does it since refreshing sqlite_stat1 is a write.
+        now = time.monotonic()
+        due = _last_optimize is None or now - _last_optimize >= OPTIMIZE_INTERVAL
+        if due and not conn.in_transaction:
+            _last_optimize = now
+            conn.execute("PRAGMA optimize")
+
+
+@contextmanager
+def write_transaction() -> Iterator[sqlite3.Connection]:
+    """Run a block on the writer inside BEGIN IMMEDIATE ... COMMIT.
+
+    Taking the write lock up front avoids the deferred-to-write upgrade that
+    fails with "database is locked" under concurrent writers.
+    """
+    with get_writer() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        conn.commit()
+
+
+DAY = 86400
+SLA_STATES = ("up", "degraded", "down")
+
+# sla_daily holds the seconds spent in each state per office per UTC day, for
+# every closed segment (one state change to the next). The open segment after
+# an office's latest change is added at query time.
+_ADD_SLA_DAILY_SQL = """
+INSERT INTO sla_daily(office_id, day, sec_up, sec_deg, sec_down)
+VALUES (?,?,?,?,?)
+ON CONFLICT(office_id, day) DO UPDATE SET
+    sec_up=sec_up+excluded.sec_up,
+    sec_deg=sec_deg+excluded.sec_deg,
+    sec_down=sec_down+excluded.sec_down
+"""
+
+
+def day_buckets(state: str, start: int, end: int, sign: int = 1):
+    """Split [start, end) into (day, sec_up, sec_deg, sec_down) rows."""
+    if state not in SLA_STATES:
+        return []
+    col = SLA_STATES.index(state)
+    out = []
+    while start < end:
+        day = start // DAY
+        stop = min(end, (day + 1) * DAY)
+        secs = [0, 0, 0]
+        secs[col] = sign * (stop - start)
+        out.append((day, *secs))
+        start = stop
+    return out
+
+
+def rebuild_sla_daily(conn):
+    conn.execute("DELETE FROM sla_daily")
+    rows = []
+    prev = None
+    for r in conn.execute(
+        "SELECT office_id, at_ts, to_state FROM state_changes ORDER BY office_id, at_ts"
+    ).fetchall():
+        if prev is not None and prev["office_id"] == r["office_id"]:
+            rows.extend(
+                (r["office_id"], *b)
+                for b in day_buckets(prev["to_state"], prev["at_ts"], r["at_ts"])
+            )
+        prev = r
+    conn.executemany(_ADD_SLA_DAILY_SQL, rows)
+
+
+def neighbour_changes(conn, oid: int, at: int):
+    """The (at_ts, to_state) change just before `at` and the at_ts just after."""
+    prev = conn.execute(
+        "SELECT at_ts, to_state FROM state_changes WHERE office_id=? AND at_ts<? "
+        "ORDER BY at_ts DESC LIMIT 1",
+        (oid, at),
+    ).fetchone()
+    nxt = conn.execute(
+        "SELECT at_ts FROM state_changes WHERE office_id=? AND at_ts>? "
+        "ORDER BY at_ts LIMIT 1",
+        (oid, at),
+    ).fetchone()
+    return (tuple(prev) if prev else None), (nxt[0] if nxt else None)
+
+
+def roll_up_state_change(
+    conn,
+    oid: int,
+    at: int,
+    state: str,
+    prev: Optional[tuple[int, str]],
+    next_at: Optional[int],
+):
+    """Fold a newly inserted state change into sla_daily.
+
+    Events normally arrive in order, closing the previous segment. A late
+    event splits an already closed segment, moving its tail to the new state.
+    """
+    rows = []
+    if next_at is not None:
+        rows += day_buckets(state, at, next_at)
+        if prev is not None:
+            rows += day_buckets(prev[1], at, next_at, sign=-1)
+    elif prev is not None:
+        rows += day_buckets(prev[1], prev[0], at)
+    conn.executemany(_ADD_SLA_DAILY_SQL, [(oid, *r) for r in rows])
+
+
 def init():
     conn = db()
     cur = conn.cursor()
+    if cur.execute("PRAGMA user_version").fetchone()[0] == CURRENT_SCHEMA_VERSION:
+        conn.close()
+        return
+    has_rollup = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='sla_daily'"
+    ).fetchone()
     cur.executescript(
         """
     CREATE TABLE IF NOT EXISTS offices (
@@ -34,27 +255,33 @@ def init():
       at_ts INTEGER NOT NULL,
       from_state TEXT NOT NULL,
       to_state TEXT NOT NULL,
-      sample_gateway INTEGER NOT NULL,
-      sample_mx INTEGER NOT NULL,
-      sample_ipsec INTEGER NOT NULL,
+      sample_bits INTEGER NOT NULL,  -- same layout as samples.status
       UNIQUE (office_id, at_ts)
     );
-    CREATE INDEX IF NOT EXISTS idx_state_changes_office_ts
-      ON state_changes (office_id, at_ts);
+    CREATE INDEX IF NOT EXISTS idx_sc_cover
+      ON state_changes (office_id, at_ts, to_state, from_state);
+    CREATE INDEX IF NOT EXISTS idx_sc_office_ts_desc
+      ON state_changes (office_id, at_ts DESC);
     CREATE TABLE IF NOT EXISTS samples (
       id INTEGER PRIMARY KEY,
       office_id INTEGER NOT NULL REFERENCES offices(id),
       ts INTEGER NOT NULL,
-      gateway INTEGER NOT NULL,
-      mx INTEGER NOT NULL,
-      ipsec INTEGER NOT NULL
+      status INTEGER NOT NULL  -- see SAMPLE_GATEWAY / SAMPLE_MX / SAMPLE_IPSEC
     );
     CREATE INDEX IF NOT EXISTS idx_samples_office_ts
       ON samples (office_id, ts);
+    CREATE TABLE IF NOT EXISTS sla_daily (
+      office_id INTEGER NOT NULL REFERENCES offices(id),
+      day INTEGER NOT NULL,
+      sec_up INTEGER NOT NULL DEFAULT 0,
+      sec_deg INTEGER NOT NULL DEFAULT 0,
+      sec_down INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (office_id, day)
+    ) WITHOUT ROWID;
     """
     )
     conn.commit()
-    
+
     # migrations: ensure retry threshold columns exist
     cols = {row["name"] for row in cur.execute("PRAGMA table_info(offices)")}
     if "retries_down" not in cols:
@@ -65,13 +292,45 @@ def init():
         cur.execute(
             "ALTER TABLE offices ADD COLUMN retries_up INTEGER NOT NULL DEFAULT 1"
         )
+    # migrations: backfill the daily rollup from existing history
+    if not has_rollup:
+        rebuild_sla_daily(conn)
+    # migrations: idx_sc_cover and idx_sc_office_ts_desc serve every
+    # state_changes lookup; the plain (office_id, at_ts) index only duplicated
+    # the UNIQUE autoindex
+    cur.execute("DROP INDEX IF EXISTS idx_state_changes_office_ts")
+    # migrations: the latest-sample lookup joins back by rowid, which
+    # idx_samples_office_ts already carries; the wider cover index was never
+    # used but had to be maintained on every tick insert
+    cur.execute("DROP INDEX IF EXISTS idx_samples_cover")
+    # migrations: collapse per-sample gateway/mx/ipsec columns into status bits
+    cols = {row["name"] for row in cur.execute("PRAGMA table_info(samples)")}
+    if "status" not in cols:
+        cur.execute("ALTER TABLE samples ADD COLUMN status INTEGER NOT NULL DEFAULT 0")
+        cur.execute(
+            "UPDATE samples SET status = (gateway << 2) | (mx << 1) | ipsec"
+        )
+        for col in ("gateway", "mx", "ipsec"):
+            cur.execute(f"ALTER TABLE samples DROP COLUMN {col}")
+    # migrations: same bit-packing for the sample stored with each state change
+    cols = {row["name"] for row in cur.execute("PRAGMA table_info(state_changes)")}
+    if "sample_bits" not in cols:
+        cur.execute(
+            "ALTER TABLE state_changes ADD COLUMN sample_bits INTEGER NOT NULL DEFAULT 0"
+        )
+        cur.execute(
+            "UPDATE state_changes SET sample_bits ="
+            " (sample_gateway << 2) | (sample_mx << 1) | sample_ipsec"
+        )
+        for col in ("sample_gateway", "sample_mx", "sample_ipsec"):
+            cur.execute(f"ALTER TABLE state_changes DROP COLUMN {col}")
+    cur.execute(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION}")
     conn.commit()
+    # refresh planner stats so the covering indexes are picked up
+    cur.execute("ANALYZE")
     conn.close()
 
 
-init()
-
-
 class OfficeIn(BaseModel):
     name: str
     gateway_ip: str
@@ -90,6 +349,10 @@ class TickSample(BaseModel):
     ts: int
 
 
+# validates a whole tick batch straight from the JSON body in pydantic-core
+TICK_LIST_ADAPTER = TypeAdapter(List[TickSample])
+
+
 class EventStateChange(BaseModel):
     office: str
     state: Literal["up", "degraded", "down"]
@@ -106,15 +369,85 @@ class OneShotRow(BaseModel):
     ts: int
 
 
+# Hot-path statements live at module level so every call passes the same string
+# and hits sqlite3's per-connection statement cache on the pooled connections.
+_UPSERT_OFFICE_SQL = """
+INSERT INTO offices(name,gateway_ip,mx_ip,tunnel_probe_ip,retries_down,retries_up)
+VALUES (:name,:gateway_ip,:mx_ip,:tunnel_probe_ip,:retries_down,:retries_up)
+ON CONFLICT(name) DO UPDATE SET
+    gateway_ip=excluded.gateway_ip,
+    mx_ip=excluded.mx_ip,
+    tunnel_probe_ip=excluded.tunnel_probe_ip,
+    retries_down=excluded.retries_down,
+    retries_up=excluded.retries_up
+RETURNING id
+"""
+
+_INSERT_STATE_CHANGE_SQL = """
+INSERT OR IGNORE INTO state_changes(office_id, at_ts, from_state, to_state, sample_bits)
+VALUES (?,?,?,?,?)
+"""
+
+_INSERT_SAMPLE_SQL = "INSERT INTO samples(office_id, ts, status) VALUES (?,?,?)"
+
+_PRUNE_SAMPLES_SQL = "DELETE FROM samples WHERE office_id=? AND ts<?"
+
+
+# office name -> id; offices are never deleted and their ids never change, so
+# entries stay valid once cached (single API process per database)
+_office_cache: dict[str, int] = {}
+_office_cache_lock = threading.Lock()
+
+
+def _cache_office(name: str, oid: int):
+    with _office_cache_lock:
+        _office_cache[name] = oid
+
+
+def office_ids(conn, names) -> dict[str, int]:
+    """Map office names to ids, only querying SQLite for cache misses."""
+    with _office_cache_lock:
+        found = {n: _office_cache[n] for n in names if n in _office_cache}
+    missing = [n for n in names if n not in found]
+    if missing:
+        marks = ",".join("?" * len(missing))
+        rows = conn.execute(
+            f"SELECT name, id FROM offices WHERE name IN ({marks})", missing
+        ).fetchall()
+        with _office_cache_lock:
+            for row in rows:
+                _office_cache[row["name"]] = found[row["name"]] = row["id"]
+    return found
+
+
+# office_id -> (at_ts, to_state) of its latest state change, warmed when the
+# pool opens and kept current by ingest_state_change. Guarded by _writer_lock.
+# A missing entry just means "ask SQLite", never "no history".
+_last_state: dict[int, tuple[int, str]] = {}
+
+
+def load_last_states(conn):
+    _last_state.clear()
+    for r in conn.execute(_LAST_CHANGE_SQL.format(param_office="")):
+        _last_state[r["office_id"]] = (r["at_ts"], r["to_state"])
+
+
+def pack_sample(gateway, mx, ipsec) -> int:
+    return (
+        (SAMPLE_GATEWAY if gateway else 0)
+        | (SAMPLE_MX if mx else 0)
+        | (SAMPLE_IPSEC if ipsec else 0)
+    )
+
+
 def ensure_office(conn, o: OfficeIn) -> int:
-    c = conn.cursor()
-    c.execute("SELECT id FROM offices WHERE name=?", (o.name,))
-    if row := c.fetchone():
-        return row["id"]
-    c.execute(
+    # the no-op DO UPDATE makes RETURNING yield the id for existing rows too
+    row = conn.execute(
         """
         INSERT INTO offices(name,gateway_ip,mx_ip,tunnel_probe_ip,retries_down,retries_up)
         VALUES (?,?,?,?,?,?)
+        ON CONFLICT(name) DO UPDATE SET name=excluded.name
+        RETURNING id
         """,
         (
             o.name,
@@ -124,100 +457,369 @@ def ensure_office(conn, o: OfficeIn) -> int:
             o.retries_down,
             o.retries_up,
         ),
-    )
+    ).fetchone()
     conn.commit()
-    return c.lastrowid
+    _cache_office(o.name, row["id"])
+    return row["id"]
 
 
 @app.post("/offices")
-def upsert_office(o: OfficeIn):
-    conn = db()
-    try:
-        c = conn.cursor()
-        c.execute(
-            """
-            INSERT INTO offices(name,gateway_ip,mx_ip,tunnel_probe_ip,retries_down,retries_up)
-            VALUES (:name,:gateway_ip,:mx_ip,:tunnel_probe_ip,:retries_down,:retries_up)
-            ON CONFLICT(name) DO UPDATE SET
-                gateway_ip=excluded.gateway_ip,
-                mx_ip=excluded.mx_ip,
-                tunnel_probe_ip=excluded.tunnel_probe_ip,
-                retries_down=excluded.retries_down,
-                retries_up=excluded.retries_up
-        """,
-            o.model_dump(),
-        )
-        conn.commit()
-        # return id for convenience
-        row = c.execute("SELECT id FROM offices WHERE name=?", (o.name,)).fetchone()
-        return {"ok": True, "office_id": row["id"]}
-    finally:
-        conn.close()
+def upsert_office(o: Union[OfficeIn, List[OfficeIn]]):
+    # a list (e.g. the monitor's startup reconcile) is upserted in one transaction
+    batch = o if isinstance(o, list) else [o]
+    ids = {}
+    with write_transaction() as conn:
+        for rec in batch:
+            row = conn.execute(_UPSERT_OFFICE_SQL, rec.model_dump()).fetchone()
+            ids[rec.name] = row["id"]
+    for name, oid in ids.items():
+        _cache_office(name, oid)
+    # return id(s) for convenience
+    if isinstance(o, list):
+        return {"ok": True, "office_ids": ids}
+    return {"ok": True, "office_id": ids[o.name]}
 
 
 @app.post("/ingest/state_change")
 def ingest_state_change(ev: EventStateChange):
-    conn = db()
     try:
+        return _ingest_state_change(ev)
+    except sqlite3.Error:
+        # the cache may hold a change whose commit never landed
+        with _writer_lock:
+            _last_state.clear()
+        raise
+
+
+def _ingest_state_change(ev: EventStateChange):
+    with write_transaction() as conn:
         # find office
-        c = conn.cursor()
-        c.execute("SELECT id FROM offices WHERE name=?", (ev.office,))
-        row = c.fetchone()
-        if not row:
+        oid = office_ids(conn, [ev.office]).get(ev.office)
+        if oid is None:
             raise HTTPException(400, f"Unknown office '{ev.office}'")
-        oid = row["id"]
 
+        last = _last_state.get(oid)
+        if last is not None and ev.at > last[0]:
+            # in order: the cached latest change is the previous one
+            prev, next_at = last, None
+        else:
+            prev, next_at = neighbour_changes(conn, oid, ev.at)
+
+        c = conn.cursor()
         c.execute(
-            """
-            INSERT OR IGNORE INTO state_changes(office_id, at_ts, from_state, to_state,
-                                                sample_gateway, sample_mx, sample_ipsec)
-            SELECT ?, ?, COALESCE((
-                SELECT to_state FROM state_changes
-                WHERE office_id=? AND at_ts < ?
-                ORDER BY at_ts DESC LIMIT 1
-            ), 'unknown') AS from_state,
-            ?, ?, ?, ?
-        """,
+            _INSERT_STATE_CHANGE_SQL,
             (
                 oid,
                 ev.at,
-                oid,
-                ev.at,
+                prev[1] if prev else "unknown",
                 ev.state,
-                int(bool(ev.sample.get("gateway"))),
-                int(bool(ev.sample.get("mx"))),
-                int(bool(ev.sample.get("ipsec"))),
+                pack_sample(
+                    ev.sample.get("gateway"), ev.sample.get("mx"), ev.sample.get("ipsec")
+                ),
             ),
         )
-        conn.commit()
+        if c.rowcount:
+            roll_up_state_change(conn, oid, ev.at, ev.state, prev, next_at)
+            if next_at is None:
+                _last_state[oid] = (ev.at, ev.state)
         return {"ok": True, "inserted": c.rowcount}
-    finally:
-        conn.close()
 
 
-@app.post("/ingest/tick")
-def ingest_tick(samples: List[TickSample]):
-    conn = db()
-    try:
-        c = conn.cursor()
+_last_prune: Optional[float] = None  # guarded by the writer lock
+
+
+def prune_samples(conn, office_ids, newest_ts: int):
+    """Drop samples past SAMPLE_RETENTION, at most once per prune interval."""
+    global _last_prune
+    if SAMPLE_RETENTION <= 0:
+        return
+    now = time.monotonic()
+    if _last_prune is not None and now - _last_prune < SAMPLE_PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    cutoff = newest_ts - SAMPLE_RETENTION
+    conn.executemany(_PRUNE_SAMPLES_SQL, [(oid, cutoff) for oid in office_ids])
+
+
+def insert_samples(samples: List[TickSample]):
+    if not samples:
+        return {"ok": True, "count": 0}
+    with write_transaction() as conn:
+        # resolve every office at once instead of one SELECT per sample
+        name2id = office_ids(conn, list({s.office for s in samples}))
         for s in samples:
-            c.execute("SELECT id FROM offices WHERE name=?", (s.office,))
-            row = c.fetchone()
-            if not row:
+            if s.office not in name2id:
                 raise HTTPException(400, f"Unknown office '{s.office}'")
-            oid = row["id"]
-            c.execute(
-                "INSERT INTO samples(office_id, ts, gateway, mx, ipsec) VALUES (?,?,?,?,?)",
-                (oid, s.ts, int(s.gateway), int(s.mx), int(s.ipsec)),
-            )
-        conn.commit()
+        conn.executemany(
+            _INSERT_SAMPLE_SQL,
+            [
+                (name2id[s.office], s.ts, pack_sample(s.gateway, s.mx, s.ipsec))
+                for s in samples
+            ],
+        )
+        prune_samples(conn, name2id.values(), max(s.ts for s in samples))
         return {"ok": True, "count": len(samples)}
+
+
+@app.post("/ingest/tick")
+async def ingest_tick(request: Request):
+    try:
+        samples = TICK_LIST_ADAPTER.validate_json(await request.body())
+    except ValidationError as exc:
+        raise RequestValidationError(
+            [{**e, "loc": ("body", *e["loc"])} for e in exc.errors(include_url=False)]
+        )
+    return await run_in_threadpool(insert_samples, samples)
+
+
+# Seconds per state over [:a, :b) straight from state_changes; each office's
+# scan starts at its last change at or before :a, so the cost is bounded by the
+# changes inside the range rather than the whole history.
+_SPAN_SQL = """
+WITH lo AS (
+  SELECT o.id AS office_id,
+         COALESCE((
+           SELECT MAX(at_ts) FROM state_changes
+           WHERE office_id = o.id AND at_ts <= :a
+         ), :a) AS lo_ts
+  FROM offices o
+  WHERE 1=1 {param_office}
+),
+sc AS (
+  SELECT s.office_id, s.at_ts, s.to_state AS state,
+         LEAD(s.at_ts, 1, :b) OVER (PARTITION BY s.office_id ORDER BY s.at_ts) AS next_ts
+  FROM lo
+  CROSS JOIN state_changes s  -- CROSS JOIN pins lo as the outer loop
+    ON s.office_id = lo.office_id AND s.at_ts >= lo.lo_ts AND s.at_ts < :b
+)
+SELECT office_id,
+       SUM(CASE WHEN state='up' THEN next_ts - MAX(at_ts, :a) ELSE 0 END) AS sec_up,
+       SUM(CASE WHEN state='degraded' THEN next_ts - MAX(at_ts, :a) ELSE 0 END) AS sec_deg,
+       SUM(CASE WHEN state='down' THEN next_ts - MAX(at_ts, :a) ELSE 0 END) AS sec_down
+FROM sc
+WHERE next_ts > :a
+GROUP BY office_id
+"""
+
+_SLA_DAILY_SUM_SQL = """
+SELECT d.office_id,
+       SUM(d.sec_up) AS sec_up,
+       SUM(d.sec_deg) AS sec_deg,
+       SUM(d.sec_down) AS sec_down
+FROM sla_daily d
+JOIN offices o ON o.id = d.office_id
+WHERE d.day BETWEEN :d1 AND :d2 {param_office}
+GROUP BY d.office_id
+"""
+
+_LAST_CHANGE_SQL = """
+SELECT s.office_id, s.at_ts, s.to_state
+FROM offices o
+JOIN state_changes s ON s.id = (
+  SELECT id FROM state_changes WHERE office_id = o.id ORDER BY at_ts DESC LIMIT 1
+)
+WHERE 1=1 {param_office}
+"""
+
+_SLA_OFFICES_SQL = """
+SELECT o.id, o.name
+FROM offices o
+WHERE EXISTS (
+  SELECT 1 FROM state_changes WHERE office_id = o.id AND at_ts < :t_end
+) {param_office} {param_after}
+ORDER BY o.name
+LIMIT :limit
+"""
+
+# Latest state change and sample per office: one reverse step on the
+# (office_id, at_ts) / (office_id, ts) indexes each, instead of window-ranking
+# the whole history and keeping rn = 1.
+_LATEST_SQL = """
+SELECT o.id AS office_id,
+       sc.to_state AS current_state,
+       sc.at_ts AS current_at,
+       sc.from_state AS previous_state,
+       (sm.status >> 2) & 1 AS latest_gateway,
+       (sm.status >> 1) & 1 AS latest_mx,
+       sm.status & 1 AS latest_ipsec,
+       sm.ts AS latest_sample_ts
+FROM offices o
+LEFT JOIN state_changes sc ON sc.id = (
+  SELECT id FROM state_changes
+  WHERE office_id = o.id AND at_ts <= :t_end
+  ORDER BY at_ts DESC LIMIT 1
+)
+LEFT JOIN samples sm ON sm.id = (
+  SELECT id FROM samples
+  WHERE office_id = o.id AND ts <= :t_end
+  ORDER BY ts DESC LIMIT 1
+)
+WHERE 1=1 {param_office}
+"""
+
+
+def sla_seconds(conn, param_office: str, args: dict, t_start: int, t_end: int):
+    """Per-office [sec_up, sec_deg, sec_down] over [t_start, t_end).
+
+    Whole UTC days inside the window are summed from sla_daily; only the
+    partial days at either edge are computed from state_changes.
+    """
+    args = dict(args)
+    totals: dict[int, list[int]] = {}
+
+    def add(oid: int, secs):
+        acc = totals.setdefault(oid, [0, 0, 0])
+        for i, v in enumerate(secs):
+            acc[i] += v or 0
+
+    m0 = -(-t_start // DAY) * DAY  # first midnight at/after t_start
+    m1 = (t_end // DAY) * DAY  # last midnight at/before t_end
+    if m0 < m1:
+        edges = [(t_start, m0), (m1, t_end)]
+        args.update(d1=m0 // DAY, d2=m1 // DAY - 1)
+        for r in conn.execute(_SLA_DAILY_SUM_SQL.format(param_office=param_office), args):
+            add(r["office_id"], (r["sec_up"], r["sec_deg"], r["sec_down"]))
+        # the segment after each office's latest change is not rolled up yet
+        for r in conn.execute(_LAST_CHANGE_SQL.format(param_office=param_office), args):
+            if r["at_ts"] < m1:
+                for day, *secs in day_buckets(r["to_state"], max(r["at_ts"], m0), m1):
+                    add(r["office_id"], secs)
+    else:
+        edges = [(t_start, t_end)]
+
+    span_sql = _SPAN_SQL.format(param_office=param_office)
+    for a, b in edges:
+        if a < b:
+            for r in conn.execute(span_sql, {**args, "a": a, "b": b}):
+                add(r["office_id"], (r["sec_up"], r["sec_deg"], r["sec_down"]))
+    return totals
+
+
+def sla_rows(conn, offices, t_start: int, t_end: int) -> List[dict]:
+    """Build the /sla rows for a batch of (id, name) office rows."""
+    args: dict = {f"o{i}": o["id"] for i, o in enumerate(offices)}
+    param_office = f"AND o.id IN ({','.join(':' + k for k in args)})"
+    args["t_end"] = t_end
+    totals = sla_seconds(conn, param_office, args, t_start, t_end)
+    latest = {
+        r["office_id"]: r
+        for r in conn.execute(_LATEST_SQL.format(param_office=param_office), args)
+    }
+    rows = []
+    for o in offices:
+        sec_up, sec_deg, sec_down = totals.get(o["id"], (0, 0, 0))
+        lr = latest[o["id"]]
+        rows.append(
+            {
+                "office": o["name"],
+                "sec_up": sec_up,
+                "sec_deg": sec_deg,
+                "sec_down": sec_down,
+                "sec_total": t_end - t_start,
+                "current_state": lr["current_state"],
+                "current_at": lr["current_at"],
+                "previous_state": lr["previous_state"],
+                "latest_gateway": lr["latest_gateway"],
+                "latest_mx": lr["latest_mx"],
+                "latest_ipsec": lr["latest_ipsec"],
+                "latest_sample_ts": lr["latest_sample_ts"],
+            }
+        )
+    return rows
+
+
+# offices per /sla batch; bounds memory regardless of fleet size
+SLA_BATCH_SIZE = 256
+
+
+def iter_sla_batches(office: Optional[str], t_start: int, t_end: int):
+    """Yield /sla rows in office-name order, SLA_BATCH_SIZE offices at a time.
+
+    Each batch borrows a pooled reader only while it is computed, so a slow
+    client never holds a connection (or its read snapshot) between batches.
+    """
+    param_office = "AND o.name = :office" if office else ""
+    after: Optional[str] = None
+    while True:
+        with get_conn() as conn:
+            # one read transaction so the batch's queries see the same snapshot
+            conn.execute("BEGIN")
+            try:
+                batch = conn.execute(
+                    _SLA_OFFICES_SQL.format(
+                        param_office=param_office,
+                        param_after="AND o.name > :after" if after is not None else "",
+                    ),
+                    {
+                        "office": office,
+                        "t_end": t_end,
+                        "after": after,
+                        "limit": SLA_BATCH_SIZE,
+                    },
+                ).fetchall()
+                rows = sla_rows(conn, batch, t_start, t_end) if batch else []
+            finally:
+                conn.rollback()
+        if not rows:
+            return
+        add_uptime(rows)
+        yield rows
+        if len(batch) < SLA_BATCH_SIZE:
+            return
+        after = batch[-1]["name"]
+
+
+# below this many rows the NumPy setup costs more than the Python loop
+VECTORIZE_MIN_ROWS = 50
+
+
+def add_uptime(rows: List[dict]):
+    """Attach uptime_strict / uptime_lenient ratios to each sla row."""
+    if len(rows) >= VECTORIZE_MIN_ROWS:
+        n = len(rows)
+        up = np.fromiter((r["sec_up"] for r in rows), dtype=np.int64, count=n)
+        deg = np.fromiter((r["sec_deg"] for r in rows), dtype=np.int64, count=n)
+        total = np.maximum(
+            np.fromiter((r["sec_total"] for r in rows), dtype=np.int64, count=n), 1
+        )
+        # divide in NumPy but round in Python: np.round scales by 10**6 and
+        # can land a half-ulp away from round(), so batches of different
+        # sizes would disagree on the same office's ratio
+        strict = (up / total).tolist()
+        lenient = ((up + deg) / total).tolist()
+        for r, st, le in zip(rows, strict, lenient):
+            r["uptime_strict"] = round(st, 6)
+            r["uptime_lenient"] = round(le, 6)
+        return
+    for r in rows:
+        total = max(1, r["sec_total"])
+        r["uptime_strict"] = round(r["sec_up"] / total, 6)
+        r["uptime_lenient"] = round((r["sec_up"] + r["sec_deg"]) / total, 6)
+
+
+def sla_chunks(office: Optional[str], t_start: int, t_end: int):
+    """Encode the /sla document batch by batch (blocking; runs off the loop)."""
+    yield b'{"window":' + orjson.dumps({"t_start": t_start, "t_end": t_end})
+    yield b',"sla":['
+    sep = b""
+    for rows in iter_sla_batches(office, t_start, t_end):
+        yield sep + b",".join(orjson.dumps(r) for r in rows)
+        sep = b","
+    yield b"]}"
+
+
+async def stream_in_threadpool(chunks):
+    """Step a blocking generator on the threadpool, one chunk per hop."""
+    try:
+        while (chunk := await run_in_threadpool(next, chunks, None)) is not None:
+            yield chunk
     finally:
-        conn.close()
+        # closes the generator even if the client went away
+        chunks.close()
 
 
 @app.get("/sla")
-def sla(
+async def sla(
     office: Optional[str] = None,
     t_start: Optional[int] = None,
     t_end: Optional[int] = None,
@@ -225,93 +827,7 @@ def sla(
     now = int(time.time())
     t_end = t_end or now
     t_start = t_start or (t_end - 86400)  # default last 24h
-    conn = db()
-    try:
-        c = conn.cursor()
-        param_office = ""
-        args: dict = {"t_start": t_start, "t_end": t_end}
-        if office:
-            param_office = "AND o.name = :office"
-            args["office"] = office
-
-        # build state spans
-        sql = f"""
-        WITH sc AS (
-          SELECT s.office_id, s.at_ts, s.to_state AS state,
-                 LEAD(s.at_ts, 1, :t_end) OVER (PARTITION BY s.office_id ORDER BY s.at_ts) AS next_ts
-          FROM state_changes s
-          WHERE s.at_ts < :t_end
-        ),
-        scw AS (
-          SELECT office_id,
-                 CASE WHEN at_ts < :t_start THEN :t_start ELSE at_ts END AS seg_start,
-                 CASE WHEN next_ts > :t_end  THEN :t_end  ELSE next_ts END AS seg_end,
-                 state
-          FROM sc
-          WHERE next_ts > :t_start
-        ),
-        sla AS (
-          SELECT o.name AS office,
-                 SUM(CASE WHEN state='up' THEN seg_end-seg_start ELSE 0 END) AS sec_up,
-                 SUM(CASE WHEN state='degraded' THEN seg_end-seg_start ELSE 0 END) AS sec_deg,
-                 SUM(CASE WHEN state='down' THEN seg_end-seg_start ELSE 0 END) AS sec_down,
-                 (:t_end - :t_start) AS sec_total
-          FROM scw
-          JOIN offices o ON o.id = scw.office_id
-          WHERE 1=1 {param_office}
-          GROUP BY o.name
-        ),
-        latest AS (
-          SELECT o.name AS office,
-                 s.to_state AS current_state,
-                 s.at_ts AS current_at,
-                 s.from_state AS previous_state
-          FROM (
-            SELECT office_id, to_state, at_ts, from_state,
-                   ROW_NUMBER() OVER (PARTITION BY office_id ORDER BY at_ts DESC) AS rn
-            FROM state_changes
-            WHERE at_ts <= :t_end
-          ) s
-          JOIN offices o ON o.id = s.office_id
-          WHERE rn = 1
-        ),
-        latest_samples AS (
-          SELECT o.name AS office,
-                 sample.gateway,
-                 sample.mx,
-                 sample.ipsec,
-                 sample.ts
-          FROM (
-            SELECT office_id, gateway, mx, ipsec, ts,
-                   ROW_NUMBER() OVER (PARTITION BY office_id ORDER BY ts DESC) AS rn
-            FROM samples
-            WHERE ts <= :t_end
-          ) sample
-          JOIN offices o ON o.id = sample.office_id
-          WHERE rn = 1
-        )
-        SELECT sla.office,
-               sla.sec_up,
-               sla.sec_deg,
-               sla.sec_down,
-               sla.sec_total,
-               latest.current_state,
-               latest.current_at,
-               latest.previous_state,
-               latest_samples.gateway AS latest_gateway,
-               latest_samples.mx AS latest_mx,
-               latest_samples.ipsec AS latest_ipsec,
-               latest_samples.ts AS latest_sample_ts
-        FROM sla
-        LEFT JOIN latest ON latest.office = sla.office
-        LEFT JOIN latest_samples ON latest_samples.office = sla.office
-        ORDER BY sla.office;
-        """
-        rows = [dict(r) for r in c.execute(sql, args).fetchall()]
-        for r in rows:
-            total = max(1, r["sec_total"])
-            r["uptime_strict"] = round(r["sec_up"] / total, 6)
-            r["uptime_lenient"] = round((r["sec_up"] + r["sec_deg"]) / total, 6)
-        return {"window": {"t_start": t_start, "t_end": t_end}, "sla": rows}
-    finally:
-        conn.close()
+    return StreamingResponse(
+        stream_in_threadpool(sla_chunks(office, t_start, t_end)),
+        media_type="application/json",
+    )
@@ -64,6 +64,29 @@ def test_offices_create_and_update(api_client):
         conn.close()
 
 
+def test_offices_accepts_batch(api_client):
+    client, module = api_client
+    payload, create_body = _post_office(client)
+
+    branch = dict(payload, name="Branch", gateway_ip="4.4.4.4")
+    payload["retries_down"] = 7
+    resp = client.post("/offices", json=[payload, branch])
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["ok"] is True
+    assert body["office_ids"]["HQ"] == create_body["office_id"]
+    assert body["office_ids"]["Branch"] != create_body["office_id"]
+
+    conn = module.db()
+    try:
+        rows = conn.execute(
+            "SELECT name, gateway_ip, retries_down FROM offices ORDER BY name"
+        ).fetchall()
+        assert [tuple(r) for r in rows] == [("Branch", "4.4.4.4", 3), ("HQ", "1.1.1.1", 7)]
+    finally:
+        conn.close()
+
+
 def test_ingest_state_change_transitions_and_overlap(api_client):
     client, module = api_client
     _post_office(client)
@@ -149,14 +172,13 @@ def test_ingest_tick_inserts_samples(api_client):
 
     conn = module.db()
     try:
-        rows = conn.execute(
-            "SELECT ts, gateway, mx, ipsec FROM samples ORDER BY ts"
-        ).fetchall()
+        rows = conn.execute("SELECT ts, status FROM samples ORDER BY ts").fetchall()
         assert len(rows) == 2
         assert rows[0]["ts"] == 10
-        assert rows[0]["gateway"] == 1
-        assert rows[0]["mx"] == 0
-        assert rows[1]["mx"] == 1
+        assert rows[0]["status"] & module.SAMPLE_GATEWAY
+        assert not rows[0]["status"] & module.SAMPLE_MX
+        assert rows[0]["status"] & module.SAMPLE_IPSEC
+        assert rows[1]["status"] & module.SAMPLE_MX
     finally:
         conn.close()
 
@@ -245,3 +267,249 @@ def test_sla_window_and_metrics(api_client):
     resp = client.get("/sla", params={"office": "UNKNOWN", "t_start": 0, "t_end": 150})
     assert resp.status_code == 200
     assert resp.json()["sla"] == []
+
+
+def test_db_connections_use_wal(api_client):
+    _, module = api_client
+    conn = module.db()
+    try:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    finally:
+        conn.close()
+
+
+def test_sla_multi_day_window_uses_daily_rollup(api_client):
+    client, module = api_client
+    _post_office(client)
+    day = 86400
+
+    def change(state, at):
+        resp = client.post(
+            "/ingest/state_change",
+            json={
+                "office": "HQ",
+                "state": state,
+                "sample": {"gateway": True, "mx": True, "ipsec": True},
+                "at": at,
+            },
+        )
+        assert resp.status_code == 200
+
+    change("down", 0)
+    change("up", day + day // 2)
+    change("degraded", 3 * day + day // 5)
+    # a late event splits the already closed "up" segment
+    change("down", 2 * day + day // 2)
+
+    conn = module.db()
+    try:
+        rolled = conn.execute(
+            "SELECT SUM(sec_up), SUM(sec_deg), SUM(sec_down) FROM sla_daily"
+        ).fetchone()
+        assert tuple(rolled) == (day, 0, day + day // 2 + (day * 7) // 10)
+    finally:
+        conn.close()
+
+    t_start, t_end = day // 2, 4 * day
+    resp = client.get("/sla", params={"t_start": t_start, "t_end": t_end})
+    assert resp.status_code == 200
+    (entry,) = resp.json()["sla"]
+    assert entry["sec_down"] == day + (day * 7) // 10
+    assert entry["sec_up"] == day
+    assert entry["sec_deg"] == 4 * day - (3 * day + day // 5)
+    assert entry["sec_total"] == t_end - t_start
+    assert entry["current_state"] == "degraded"
+
+
+def test_add_uptime_vectorized_matches_scalar(api_client):
+    _, module = api_client
+    # every ratio n/86400 of a day window, including those (e.g. 27/86400)
+    # where np.round and round() disagree in the last digit
+    rows = [
+        {"sec_up": i, "sec_deg": 86400 - i, "sec_total": 86400} for i in range(86401)
+    ]
+    rows += [
+        {"sec_up": i * 7, "sec_deg": i * 3, "sec_total": 1000 + i} for i in range(100)
+    ]
+    vectorized = [dict(r) for r in rows]
+    module.add_uptime(vectorized)
+    for r, v in zip(rows, vectorized):
+        module.add_uptime([r])  # below VECTORIZE_MIN_ROWS: the scalar path
+        assert v["uptime_strict"] == r["uptime_strict"]
+        assert v["uptime_lenient"] == r["uptime_lenient"]
+        assert type(v["uptime_strict"]) is float
+
+
+def test_ingest_tick_rejects_invalid_batch(api_client):
+    client, _ = api_client
+    _post_office(client)
+    resp = client.post("/ingest/tick", json=[{"office": "HQ", "gateway": True}])
+    assert resp.status_code == 422
+    assert resp.json()["detail"][0]["loc"][:2] == ["body", 0]
+
+
+def test_ingest_tick_prunes_expired_samples(api_client, monkeypatch):
+    client, module = api_client
+    _post_office(client)
+    monkeypatch.setattr(module, "SAMPLE_RETENTION", 100)
+    monkeypatch.setattr(module, "SAMPLE_PRUNE_INTERVAL", 0)
+
+    def tick(ts):
+        sample = {"office": "HQ", "gateway": True, "mx": True, "ipsec": True, "ts": ts}
+        assert client.post("/ingest/tick", json=[sample]).status_code == 200
+
+    tick(10)
+    tick(500)
+
+    conn = module.db()
+    try:
+        rows = conn.execute("SELECT ts FROM samples ORDER BY ts").fetchall()
+        assert [row["ts"] for row in rows] == [500]
+    finally:
+        conn.close()
+
+
+def test_init_records_schema_version(api_client):
+    _, module = api_client
+    conn = module.db()
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        assert version == module.CURRENT_SCHEMA_VERSION
+    finally:
+        conn.close()
+    # already current: a second run is a no-op
+    module.init()
+
+
+def test_init_drops_redundant_indexes(api_client):
+    _, module = api_client
+    conn = module.db()
+    try:
+        # as left behind by schema version 3
+        conn.execute("CREATE INDEX idx_samples_cover ON samples (office_id, ts, status)")
+        conn.execute(
+            "CREATE INDEX idx_state_changes_office_ts ON state_changes (office_id, at_ts)"
+        )
+        conn.execute("PRAGMA user_version = 3")
+        conn.commit()
+        module.init()
+        names = {
+            r["name"]
+            for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        }
+        assert "idx_samples_cover" not in names
+        assert "idx_state_changes_office_ts" not in names
+        assert {"idx_sc_cover", "idx_sc_office_ts_desc"} <= names
+        assert "idx_samples_office_ts" in names
+        plan = " ".join(
+            r["detail"]
+            for r in conn.execute(
+                "EXPLAIN QUERY PLAN " + module._LATEST_SQL.format(param_office=""),
+                {"t_end": 0},
+            )
+        )
+        assert "idx_samples_office_ts" in plan
+    finally:
+        conn.close()
+
+
+def test_ingest_state_change_from_state_with_late_event(api_client):
+    client, module = api_client
+    _post_office(client)
+    for state, at in (("down", 100), ("up", 300), ("degraded", 200), ("down", 400)):
+        resp = client.post(
+            "/ingest/state_change",
+            json={"office": "HQ", "state": state, "sample": {}, "at": at},
+        )
+        assert resp.json() == {"ok": True, "inserted": 1}
+
+    conn = module.db()
+    try:
+        rows = conn.execute(
+            "SELECT at_ts, from_state, to_state FROM state_changes ORDER BY at_ts"
+        ).fetchall()
+        assert [(r["at_ts"], r["from_state"]) for r in rows] == [
+            (100, "unknown"),
+            (200, "down"),
+            (300, "down"),  # recorded before the late event arrived
+            (400, "up"),
+        ]
+    finally:
+        conn.close()
+
+
+def test_sla_streams_offices_across_batches(api_client, monkeypatch):
+    client, module = api_client
+    monkeypatch.setattr(module, "SLA_BATCH_SIZE", 2)
+    names = ["E", "C", "A", "D", "B"]
+    for name in names:
+        payload = {
+            "name": name,
+            "gateway_ip": "1.1.1.1",
+            "mx_ip": "2.2.2.2",
+            "tunnel_probe_ip": "3.3.3.3",
+        }
+        assert client.post("/offices", json=payload).status_code == 200
+        resp = client.post(
+            "/ingest/state_change",
+            json={"office": name, "state": "up", "sample": {}, "at": 0},
+        )
+        assert resp.status_code == 200
+
+    resp = client.get("/sla", params={"t_start": 10, "t_end": 110})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert [r["office"] for r in body["sla"]] == sorted(names)
+    assert all(r["sec_up"] == 100 for r in body["sla"])
+
+
+def test_sla_stream_releases_reader_between_batches(api_client, monkeypatch):
+    client, module = api_client
+    monkeypatch.setattr(module, "SLA_BATCH_SIZE", 2)
+    for name in ["A", "B", "C"]:
+        payload = {
+            "name": name,
+            "gateway_ip": "1.1.1.1",
+            "mx_ip": "2.2.2.2",
+            "tunnel_probe_ip": "3.3.3.3",
+        }
+        assert client.post("/offices", json=payload).status_code == 200
+        resp = client.post(
+            "/ingest/state_change",
+            json={"office": name, "state": "up", "sample": {}, "at": 0},
+        )
+        assert resp.status_code == 200
+
+    pool = module.open_pool()
+    readers = pool.qsize()
+    chunks = module.sla_chunks(None, 10, 110)
+    parts = [next(chunks) for _ in range(3)]  # window, '"sla":[', first batch
+    # a client paused mid-stream holds no pooled reader
+    assert pool.qsize() == readers
+    parts.extend(chunks)
+    assert pool.qsize() == readers
+    body = module.orjson.loads(b"".join(parts))
+    assert [r["office"] for r in body["sla"]] == ["A", "B", "C"]
+
+
+def test_ingest_state_change_packs_sample_bits(api_client):
+    client, module = api_client
+    _post_office(client)
+    resp = client.post(
+        "/ingest/state_change",
+        json={
+            "office": "HQ",
+            "state": "degraded",
+            "sample": {"gateway": True, "mx": False, "ipsec": False},
+            "at": 5,
+        },
+    )
+    assert resp.status_code == 200
+
+    conn = module.db()
+    try:
+        row = conn.execute("SELECT sample_bits FROM state_changes").fetchone()
+        assert row["sample_bits"] == module.SAMPLE_GATEWAY
+    finally:
+        conn.close()
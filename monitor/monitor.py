@@ -1,19 +1,113 @@
-import aiohttp, asyncio, contextlib, shutil, time, json, os, random, argparse, hashlib
+import aiohttp, asyncio, contextlib, shutil, time, os, random, argparse, sys
+import atexit, ipaddress, queue, socket, threading
 import logging
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Dict, Any, Optional, List, Set, Tuple
+import orjson
 import yaml
 
+try:  # optional: event-driven config reloads (inotify/FSEvents/...)
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
+try:  # optional: in-process ICMP echo instead of spawning fping
+    import icmplib
+except ImportError:
+    icmplib = None
+
 FPING = shutil.which("fping")
+# cleared when the kernel refuses unprivileged ICMP sockets
+# (net.ipv4.ping_group_range); batch_ping then falls back to fping/ping3
+_icmp_sockets = icmplib is not None
+_icmp_checked = False
+# icmplib opens one socket per in-flight echo; cap them well below the usual
+# 1024 open-file limit
+ICMP_CONCURRENCY = int(os.environ.get("ICMP_CONCURRENCY", "256"))
 REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=5)
 API_BASE = os.environ.get("SLA_API", "http://localhost:8080")
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+# stdout lines are handed to a writer thread so a slow log pipe never blocks
+# the event loop; it flushes every LOG_FLUSH_ITEMS lines or LOG_FLUSH_SEC
+LOG_FLUSH_ITEMS = 100
+LOG_FLUSH_SEC = 0.05
+_log_q: "queue.SimpleQueue[Optional[bytes]]" = queue.SimpleQueue()
+_log_thread: Optional[threading.Thread] = None
+_log_thread_lock = threading.Lock()
+
+
+def _drain_log():
+    out = sys.stdout.buffer
+    stop = False
+    while not stop:
+        line = _log_q.get()
+        if line is None:
+            break
+        batch = [line]
+        deadline = time.monotonic() + LOG_FLUSH_SEC
+        while len(batch) < LOG_FLUSH_ITEMS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                line = _log_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if line is None:
+                stop = True
+                break
+            batch.append(line)
+        out.write(b"".join(batch))
+        out.flush()
+
+
+def _start_log_writer():
+    global _log_thread
+    with _log_thread_lock:
+        if _log_thread is None:
+            _log_thread = threading.Thread(
+                target=_drain_log, name="stdout-writer", daemon=True
+            )
+            _log_thread.start()
+            atexit.register(flush_log)
+
+
+def flush_log(timeout: float = 2.0):
+    """Stop the writer thread once everything queued so far is on stdout."""
+    global _log_thread
+    with _log_thread_lock:
+        t, _log_thread = _log_thread, None
+    if t is not None:
+        _log_q.put(None)
+        t.join(timeout)
+
+
+def emit_line(line: bytes):
+    if _log_thread is None:
+        _start_log_writer()
+    _log_q.put_nowait(line + b"\n")
+
+
+def emit(record: Dict[str, Any]):
+    # one JSON line per event on stdout, encoded straight to bytes
+    emit_line(orjson.dumps(record))
+
+
+JITTER_TABLE_SIZE = 256  # power of two: indexes wrap with a mask
+
+
+def jitter_table() -> Tuple[float, ...]:
+    # uniform [0, 1) draws; callers scale them by their cadence's max jitter
+    return tuple(random.random() for _ in range(JITTER_TABLE_SIZE))
+
+
+@dataclass(slots=True)
 class Office:
     name: str
     gateway_ip: str
@@ -21,11 +115,54 @@ class Office:
     tunnel_probe_ip: str
     retries_down: int = 2
     retries_up: int = 1
+    # when set, a new state must hold for debounce_ms before it is committed;
+    # otherwise retries_down/retries_up consecutive probes are required
+    debounce_ms: Optional[int] = None
     state: str = "unknown"
     _fail_streak: int = 0
     _ok_streak: int = 0
+    _pending_state: Optional[str] = None
+    _pending_since: float = 0.0
     last_change: float = field(default_factory=time.time)
     last_sample: Dict[str, Any] = field(default_factory=dict)
+    # cached /offices payload (and its JSON), rebuilt by refresh_payload()
+    _office_payload: Dict[str, Any] = field(
+        init=False, repr=False, default_factory=dict
+    )
+    _office_json: bytes = field(init=False, repr=False, default=b"")
+    # this office's tick summary entry, updated in place by observe()
+    _tick_dict: Dict[str, Any] = field(init=False, repr=False, default_factory=dict)
+    # probe targets as pinged: IPv4 addresses once resolve_office() has run
+    _gw_addr: str = field(init=False, repr=False, default="")
+    _mx_addr: str = field(init=False, repr=False, default="")
+    _tunnel_addr: str = field(init=False, repr=False, default="")
+    # set by observe() when state or reachability changed since the last tick
+    _dirty: bool = field(init=False, repr=False, default=True)
+
+    def __post_init__(self):
+        self._tick_dict = {"office": self.name, "state": self.state}
+        self.refresh_payload()
+        self.reset_addrs()
+
+    def reset_addrs(self):
+        self._gw_addr = self.gateway_ip
+        self._mx_addr = self.mx_ip
+        self._tunnel_addr = self.tunnel_probe_ip
+
+    def refresh_payload(self):
+        self._office_payload = {
+            "name": self.name,
+            "gateway_ip": self.gateway_ip,
+            "mx_ip": self.mx_ip,
+            "tunnel_probe_ip": self.tunnel_probe_ip,
+            "retries_down": self.retries_down,
+            "retries_up": self.retries_up,
+        }
+        self._office_json = orjson.dumps(self._office_payload)
+
+
+_DEFAULT_RETRIES_DOWN = Office.__dataclass_fields__["retries_down"].default
+_DEFAULT_RETRIES_UP = Office.__dataclass_fields__["retries_up"].default
 
 
 def instant_state(gw: bool, mx: bool, ipsec: bool) -> str:
@@ -59,27 +196,216 @@ async def ping_host(host: str, timeout_ms: int = 900) -> bool:
             return False
 
 
+def can_batch() -> bool:
+    # whether batch_ping can probe every target at once
+    return _icmp_sockets or FPING is not None
+
+
+async def batch_ping(
+    hosts: List[str],
+    timeout_ms: int = 900,
+    limiter: Optional[asyncio.Semaphore] = None,
+) -> Dict[str, bool]:
+    """Ping all hosts in one go; returns host -> reachable.
+
+    Uses icmplib's unprivileged ICMP sockets when available, else a single
+    fping process, else ping3 per host.
+    """
+    hosts = list(dict.fromkeys(hosts))
+    if not hosts:
+        return {}
+    if _icmp_sockets:
+        alive = await _icmplib_ping(hosts, timeout_ms)
+        if alive is not None:
+            return alive
+    if FPING:
+        return await _fping_many(hosts, timeout_ms)
+    results = await asyncio.gather(
+        *(limited_ping(h, limiter, timeout_ms) for h in hosts)
+    )
+    return dict(zip(hosts, results))
+
+
+def _is_ip_literal(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _disable_icmp_sockets():
+    global _icmp_sockets
+    logger.warning(
+        "Unprivileged ICMP sockets are not permitted; falling back to %s",
+        "fping" if FPING else "ping3",
+    )
+    _icmp_sockets = False
+
+
+async def _icmplib_ping(
+    hosts: List[str], timeout_ms: int
+) -> Optional[Dict[str, bool]]:
+    global _icmp_checked
+    if not _icmp_checked:
+        # check once up front: a denied batch fails every ping task at once
+        # and leaves their exceptions unretrieved
+        _icmp_checked = True
+        try:
+            icmplib.ICMPv4Socket(privileged=False).close()
+        except icmplib.SocketPermissionError:
+            _disable_icmp_sockets()
+            return None
+    # async_multiping re-raises the first failed lookup and discards the whole
+    # batch, so only IP literals go to icmplib; a name still unresolved
+    # after resolve_office() counts as unreachable
+    alive = dict.fromkeys(hosts, False)
+    ips = [h for h in hosts if _is_ip_literal(h)]
+    if not ips:
+        return alive
+    try:
+        # one echo per host per cycle, up to ICMP_CONCURRENCY in flight
+        results = await icmplib.async_multiping(
+            ips,
+            count=1,
+            timeout=timeout_ms / 1000.0,
+            concurrent_tasks=min(len(ips), ICMP_CONCURRENCY),
+            privileged=False,
+        )
+    except icmplib.SocketPermissionError:
+        _disable_icmp_sockets()
+        return None
+    except icmplib.ICMPLibError:
+        logger.debug("icmplib batch failed", exc_info=True)
+        return None
+    except OSError:
+        # e.g. EMFILE: out of file descriptors; retry this batch with fping
+        logger.warning("icmplib batch failed", exc_info=True)
+        return None
+    # results come back in the order the addresses were passed
+    alive.update((host, r.is_alive) for host, r in zip(ips, results))
+    return alive
+
+
+async def _fping_many(hosts: List[str], timeout_ms: int) -> Dict[str, bool]:
+    # one fping for every target: -C1 sends a single probe each, and -i1
+    # spaces them 1 ms apart (fping's default gap is 10 ms, which would
+    # stretch a large fleet's batch past the probe interval)
+    proc = await asyncio.create_subprocess_exec(
+        FPING,
+        "-C1",
+        "-q",
+        "-i1",
+        f"-t{timeout_ms}",
+        *hosts,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, err = await proc.communicate()
+    # with -C1 -q fping reports one "host : rtt" or "host : -" line per target
+    alive = dict.fromkeys(hosts, False)
+    for line in err.decode(errors="replace").splitlines():
+        host, sep, rtt = line.partition(" : ")
+        if sep and host.strip() in alive:
+            alive[host.strip()] = rtt.strip() not in ("", "-")
+    return alive
+
+
+async def resolve_host(host: str, cached: str) -> str:
+    """IPv4 address for host; IP literals pass through.
+
+    A failed lookup keeps the cached address (the raw name if it never
+    resolved), so a DNS blip at refresh time doesn't mark targets down.
+    """
+    if _is_ip_literal(host):
+        return host
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, None, family=socket.AF_INET, type=socket.SOCK_DGRAM
+        )
+    except OSError:
+        return cached
+    return infos[0][4][0] if infos else cached
+
+
+async def resolve_office(o: Office):
+    o._gw_addr, o._mx_addr, o._tunnel_addr = await asyncio.gather(
+        resolve_host(o.gateway_ip, o._gw_addr),
+        resolve_host(o.mx_ip, o._mx_addr),
+        resolve_host(o.tunnel_probe_ip, o._tunnel_addr),
+    )
+
+
+async def batch_probe(
+    offices: List[Office],
+    timeout_ms: int = 900,
+    limiter: Optional[asyncio.Semaphore] = None,
+) -> List[Tuple[Office, bool, bool, bool]]:
+    """(office, gateway, mx, ipsec) reachability for every office, one batch."""
+    alive = await batch_ping(
+        [ip for o in offices for ip in (o._gw_addr, o._mx_addr, o._tunnel_addr)],
+        timeout_ms,
+        limiter,
+    )
+    return [
+        (
+            o,
+            alive.get(o._gw_addr, False),
+            alive.get(o._mx_addr, False),
+            alive.get(o._tunnel_addr, False),
+        )
+        for o in offices
+    ]
+
+
 async def limited_ping(
-    host: str, limiter: asyncio.Semaphore, timeout_ms: int = 900
+    host: str, limiter: Optional[asyncio.Semaphore], timeout_ms: int = 900
 ) -> bool:
+    if limiter is None:  # concurrency cap can't be reached: skip the semaphore
+        return await ping_host(host, timeout_ms=timeout_ms)
     async with limiter:
         return await ping_host(host, timeout_ms=timeout_ms)
 
 
 # NEW: keep one session per process for efficiency
 class Ingestor:
-    def __init__(self, base: str, max_retries: int = 3, retry_backoff: float = 0.2):
+    def __init__(
+        self,
+        base: str,
+        max_retries: int = 3,
+        retry_backoff: float = 0.2,
+        inflight_limit: Optional[int] = None,
+    ):
         self.base = base
         self._session: Optional[aiohttp.ClientSession] = None
         self.max_retries = max_retries
         self.retry_backoff = retry_backoff
-
-    async def __aenter__(self):
+        # caps POSTs (and their retry sleeps) in flight, so a stalled API
+        # applies backpressure instead of piling up retrying coroutines
+        if inflight_limit is None:
+            inflight_limit = int(os.environ.get("INGEST_INFLIGHT", "32"))
+        self._inflight = asyncio.Semaphore(inflight_limit)
+
+    def _open_session(self) -> aiohttp.ClientSession:
+        # every POST goes to the same API host: keep a small pool of warm
+        # keep-alive connections and cache its DNS lookup
+        connector = aiohttp.TCPConnector(
+            limit=int(os.environ.get("INGEST_POOL", "10")),
+            limit_per_host=10,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        )
         # set default timeout for all requests
-        self._session = aiohttp.ClientSession(
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={"Connection": "keep-alive"},
             raise_for_status=True,
             timeout=REQUEST_TIMEOUT,
         )
+
+    async def __aenter__(self):
+        self._session = self._open_session()
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
@@ -92,82 +418,202 @@ class Ingestor:
         payload: dict | list,
         *,
         office_name: Optional[str] = None,
+        raw: Optional[bytes] = None,
     ):
+        """POST payload as JSON; raw, if given, is its already-encoded body."""
         endpoint = f"{self.base}{path}"
         if office_name is None and isinstance(payload, dict):
             office_name = payload.get("office") or payload.get("name")
 
-        async def _send(session: aiohttp.ClientSession):
-            async with session.post(endpoint, json=payload) as resp:
-                await resp.text()
+        if self._session is None:
+            # used without "async with": open the shared session on first use
+            # rather than a throwaway one per POST
+            self._session = self._open_session()
+
+        # encode once with orjson and send the bytes as-is
+        body = raw if raw is not None else orjson.dumps(payload)
+        async with self._inflight:
+            for attempt in range(1, self.max_retries + 1):
+                try:
+                    async with self._session.post(
+                        endpoint, data=body, headers=JSON_HEADERS
+                    ) as resp:
+                        await resp.text()
+                    return
+                except Exception:
+                    logger.exception(
+                        "Failed to POST to %s (office=%s, attempt=%s)",
+                        endpoint,
+                        office_name,
+                        attempt,
+                    )
+                    if attempt >= self.max_retries:
+                        raise
+                    # exponential backoff; the jitter keeps offices that
+                    # failed together from retrying in lockstep
+                    await asyncio.sleep(
+                        self.retry_backoff * 2 ** (attempt - 1)
+                        + random.uniform(0, self.retry_backoff)
+                    )
+
 
-        for attempt in range(1, self.max_retries + 1):
-            try:
-                if self._session:
-                    await _send(self._session)
-                else:
-                    async with aiohttp.ClientSession(
-                        raise_for_status=True,
-                        timeout=REQUEST_TIMEOUT,
-                    ) as sess:
-                        await _send(sess)
-                return
-            except Exception as exc:
-                logger.exception(
-                    "Failed to POST to %s (office=%s, attempt=%s)",
-                    endpoint,
-                    office_name,
-                    attempt,
-                )
-                if attempt >= self.max_retries:
-                    raise
-                await asyncio.sleep(self.retry_backoff * attempt)
+# libyaml's C loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# path -> (fingerprint, parsed config) of the last load
+_yaml_cache: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+
+
+def config_fingerprint(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
 
 
 def load_yaml_config(path: str) -> dict:
+    # an unchanged file (same mtime and size) is not parsed again
+    key = config_fingerprint(path)
+    cached = _yaml_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
     with open(path, "r") as f:
-        return yaml.safe_load(f)
+        cfg = yaml.load(f, Loader=_YAML_LOADER)
+    _yaml_cache[path] = (key, cfg)
+    return cfg
+
+
+def office_identity(o: dict) -> tuple:
+    # relevant identity/fields compared on reconcile (change if you add more columns)
+    return (
+        o.get("name", ""),
+        o.get("gateway_ip", ""),
+        o.get("mx_ip", ""),
+        o.get("tunnel_probe_ip", ""),
+        o.get("retries_down", _DEFAULT_RETRIES_DOWN),
+        o.get("retries_up", _DEFAULT_RETRIES_UP),
+        o.get("debounce_ms"),
+    )
 
 
-def _office_default(field: str):
-    return Office.__dataclass_fields__[field].default
+def pick_limiter(
+    ping_concurrency: int,
+    n_offices: int,
+    bounded: Optional[asyncio.BoundedSemaphore] = None,
+) -> Optional[asyncio.BoundedSemaphore]:
+    # each office needs three concurrent pings; with room for all of them the
+    # limiter would never block, so don't pay for acquiring it
+    if ping_concurrency >= 3 * n_offices:
+        return None
+    return bounded if bounded is not None else asyncio.BoundedSemaphore(
+        ping_concurrency
+    )
 
 
-def hash_office_record(o: dict) -> str:
-    # stable hash of relevant identity/fields (change if you add more columns)
-    h = hashlib.sha256()
-    for k in (
-        "name",
-        "gateway_ip",
-        "mx_ip",
-        "tunnel_probe_ip",
-        "retries_down",
-        "retries_up",
-    ):
-        default = _office_default(k) if k.startswith("retries_") else ""
-        h.update(str(o.get(k, default)).encode())
-        h.update(b"|")
-    return h.hexdigest()
+class StopMonitor(Exception):
+    """Raised inside run()'s task group to end a bounded (--iterations) run."""
 
 
 class OfficeManager:
     def __init__(
-        self, limiter: asyncio.Semaphore, ingestor, interval: int, timeout_ms: int
+        self,
+        limiter: Optional[asyncio.Semaphore],
+        ingestor,
+        interval: int,
+        timeout_ms: int,
+        task_group: Optional[asyncio.TaskGroup] = None,
+        ping_concurrency: Optional[int] = None,
     ):
+        # given ping_concurrency, the manager picks the limiter itself on
+        # every reconcile (see _sync_limiter); otherwise limiter is fixed
         self.limiter = limiter
+        self.ping_concurrency = ping_concurrency
+        self._bounded = (
+            asyncio.BoundedSemaphore(ping_concurrency)
+            if ping_concurrency is not None
+            else None
+        )
         self.ingestor = ingestor
         self.interval = interval
         self.timeout_ms = timeout_ms
         self.offices: Dict[str, Office] = {}
         self.tasks: Dict[str, asyncio.Task] = {}
-        self._hashes: Dict[str, str] = {}
+        self._hashes: Dict[str, tuple] = {}
+        # with icmplib or fping available every office is probed by one
+        # batched loop; otherwise each office gets its own probe_office task
+        self.batch = can_batch()
+        self._batch_task: Optional[asyncio.Task] = None
+        self._reports: Set[asyncio.Task] = set()  # in-flight state_change posts
+        # probe tasks are created in the caller's TaskGroup when one is given
+        self._spawn = task_group.create_task if task_group else asyncio.create_task
+        self._jitter_table = jitter_table()
+        self._jitter_idx = 0
 
     def list_offices(self) -> List[Office]:
         return list(self.offices.values())
 
+    async def probe_all_offices(self):
+        await asyncio.sleep(random.uniform(0, min(0.5, self.interval / 4)))  # jitter
+        jitter_scale = min(0.25, self.interval * 0.05)
+        while True:
+            loop_start = time.monotonic()
+
+            results = await batch_probe(
+                self.list_offices(), self.timeout_ms, self.limiter
+            )
+            changed = [o for o, gw, mx, ipsec in results if observe(o, gw, mx, ipsec)]
+            # reports run in the background: a slow or retrying POST must not
+            # hold up the next probe cycle for the whole fleet
+            for o in changed:
+                t = self._spawn(self._report(o))
+                self._reports.add(t)
+                t.add_done_callback(self._reports.discard)
+
+            # steady cadence
+            elapsed = time.monotonic() - loop_start
+            next_sleep = max(0.0, self.interval - elapsed)
+            next_sleep += (
+                self._jitter_table[self._jitter_idx & (JITTER_TABLE_SIZE - 1)]
+                * jitter_scale
+            )
+            self._jitter_idx += 1
+            await asyncio.sleep(next_sleep)
+
+    async def _report(self, office: Office):
+        # post_json has already logged the failure; a lost report must not
+        # take down the task group
+        with contextlib.suppress(Exception):
+            await report_state_change(office, self.ingestor)
+
+    async def refresh_dns(self, ttl: float = 300):
+        # offices may name their targets by DNS; pick up address changes
+        while True:
+            await asyncio.sleep(ttl)
+            await asyncio.gather(*(resolve_office(o) for o in self.list_offices()))
+
+    def _start_probe(self, o: Office):
+        self.tasks[o.name] = self._spawn(
+            probe_office(
+                o,
+                self.limiter,
+                self.ingestor,
+                self.interval,
+                self.timeout_ms,
+            )
+        )
+
+    def _sync_limiter(self, n_offices: int):
+        if self.ping_concurrency is None:
+            return
+        limiter = pick_limiter(self.ping_concurrency, n_offices, self._bounded)
+        if limiter is self.limiter:
+            return
+        self.limiter = limiter
+        # running per-office probes hold the old limiter; restart them
+        for name, t in list(self.tasks.items()):
+            t.cancel()
+            self._start_probe(self.offices[name])
+
     async def reconcile(self, offices_cfg: dict):
         desired = {o["name"]: o for o in offices_cfg.get("offices", [])}
-        desired_hashes = {name: hash_office_record(o) for name, o in desired.items()}
+        desired_hashes = {name: office_identity(o) for name, o in desired.items()}
 
         # removals
         for name in list(self.offices.keys()):
@@ -178,169 +624,259 @@ class OfficeManager:
                 self.offices.pop(name, None)
                 self._hashes.pop(name, None)
 
-        # additions/updates
+        self._sync_limiter(len(desired))
+
+        # additions/updates, sent to the API as one batched upsert. Targets
+        # are resolved and the upsert awaited before anything is published:
+        # the probe loop must not ping raw hostnames, or report a state
+        # change for an office the API hasn't stored yet
+        added: List[Office] = []
+        updated: List[Tuple[Office, Office]] = []  # (live office, staged copy)
         for name, rec in desired.items():
-            h = desired_hashes[name]
             if name not in self.offices:
-                # new office
-                o = Office(**rec)
-                self.offices[name] = o
-                self._hashes[name] = h
-                self.tasks[name] = asyncio.create_task(
-                    probe_office(
-                        o, self.limiter, self.ingestor, self.interval, self.timeout_ms
-                    )
-                )
-                await self.ingestor.post_json(
-                    "/offices",
-                    {
-                        "name": o.name,
-                        "gateway_ip": o.gateway_ip,
-                        "mx_ip": o.mx_ip,
-                        "tunnel_probe_ip": o.tunnel_probe_ip,
-                        "retries_down": o.retries_down,
-                        "retries_up": o.retries_up,
-                    },
-                    office_name=o.name,
-                )
-            elif self._hashes.get(name) != h:
-                # updated IPs (or future fields)
+                added.append(Office(**rec))
+            elif self._hashes.get(name) != desired_hashes[name]:
+                # updated IPs (or future fields): staged on a copy so the live
+                # office keeps probing its old addresses meanwhile
                 o = self.offices[name]
-                o.gateway_ip = rec["gateway_ip"]
-                o.mx_ip = rec["mx_ip"]
-                o.tunnel_probe_ip = rec["tunnel_probe_ip"]
-                o.retries_down = rec.get(
-                    "retries_down", _office_default("retries_down")
-                )
-                o.retries_up = rec.get("retries_up", _office_default("retries_up"))
-                self._hashes[name] = h
-                await self.ingestor.post_json(
-                    "/offices",
-                    {
-                        "name": o.name,
-                        "gateway_ip": o.gateway_ip,
-                        "mx_ip": o.mx_ip,
-                        "tunnel_probe_ip": o.tunnel_probe_ip,
-                        "retries_down": o.retries_down,
-                        "retries_up": o.retries_up,
-                    },
-                    office_name=o.name,
-                )
+                staged = Office(**rec)
+                # unchanged targets keep their last good address if the
+                # lookup fails
+                if staged.gateway_ip == o.gateway_ip:
+                    staged._gw_addr = o._gw_addr
+                if staged.mx_ip == o.mx_ip:
+                    staged._mx_addr = o._mx_addr
+                if staged.tunnel_probe_ip == o.tunnel_probe_ip:
+                    staged._tunnel_addr = o._tunnel_addr
+                updated.append((o, staged))
+
+        upserts = added + [staged for _, staged in updated]
+        if not upserts:
+            return
+        await asyncio.gather(*(resolve_office(o) for o in upserts))
+        await self.ingestor.post_json(
+            "/offices",
+            [o._office_payload for o in upserts],
+            raw=b"[" + b",".join(o._office_json for o in upserts) + b"]",
+        )
+
+        for o, staged in updated:
+            o.gateway_ip = staged.gateway_ip
+            o.mx_ip = staged.mx_ip
+            o.tunnel_probe_ip = staged.tunnel_probe_ip
+            o._gw_addr = staged._gw_addr
+            o._mx_addr = staged._mx_addr
+            o._tunnel_addr = staged._tunnel_addr
+            o.retries_down = staged.retries_down
+            o.retries_up = staged.retries_up
+            o.debounce_ms = staged.debounce_ms
+            o._office_payload = staged._office_payload
+            o._office_json = staged._office_json
+            self._hashes[o.name] = desired_hashes[o.name]
+
+        for o in added:
+            self.offices[o.name] = o
+            self._hashes[o.name] = desired_hashes[o.name]
+            if not self.batch:
+                self._start_probe(o)
+        if added and self.batch and self._batch_task is None:
+            self._batch_task = self._spawn(self.probe_all_offices())
+
+
+def _debounce_timer(office: Office, new_state: str) -> bool:
+    # commit a new state once it has been seen continuously for debounce_ms;
+    # any flip back (or to a third state) restarts the timer
+    now = time.monotonic()
+    if new_state == office.state:
+        office._pending_state = None
+        return False
+    if new_state != office._pending_state:
+        office._pending_state = new_state
+        office._pending_since = now
+    if now - office._pending_since < office.debounce_ms / 1000.0:
+        return False
+    office.state = new_state
+    office._pending_state = None
+    office.last_change = time.time()
+    return True
+
+
+def observe(office: Office, gw: bool, mx: bool, ipsec: bool) -> bool:
+    """Record one probe result; returns True when the debounced state changed."""
+    new_state = instant_state(gw, mx, ipsec)
+
+    # debounce
+    changed = False
+    if office.debounce_ms is not None:
+        changed = _debounce_timer(office, new_state)
+    elif new_state == office.state:
+        office._ok_streak += 1
+        office._fail_streak = 0
+    elif new_state in {"down", "degraded"} and office.state in {"up", "unknown"}:
+        office._fail_streak += 1
+        if office._fail_streak >= office.retries_down:
+            office.state = new_state
+            office._fail_streak = 0
+            office._ok_streak = 0
+            office.last_change = time.time()
+            changed = True
+    else:
+        office._ok_streak += 1
+        if office._ok_streak >= office.retries_up:
+            office.state = new_state
+            office._ok_streak = 0
+            office._fail_streak = 0
+            office.last_change = time.time()
+            changed = True
+
+    prev = office.last_sample
+    if changed or (gw, mx, ipsec) != (
+        prev.get("gateway"),
+        prev.get("mx"),
+        prev.get("ipsec"),
+    ):
+        office._dirty = True
+    office.last_sample = {
+        "gateway": gw,
+        "mx": mx,
+        "ipsec": ipsec,
+        "ts": int(time.time()),
+    }
+    office._tick_dict["state"] = office.state
+    office._tick_dict.update(office.last_sample)
+    return changed
+
+
+async def report_state_change(office: Office, ingestor: Ingestor):
+    # print for logs
+    emit(
+        {
+            "event": "state_change",
+            "office": office.name,
+            "state": office.state,
+            "sample": office.last_sample,
+            "at": int(office.last_change),
+        }
+    )
+    # NEW: ingest state_change
+    await ingestor.post_json(
+        "/ingest/state_change",
+        {
+            "office": office.name,
+            "state": office.state,
+            "sample": office.last_sample,
+            "at": int(office.last_change),
+        },
+    )
 
 
 async def probe_office(
     office: Office,
-    limiter: asyncio.Semaphore,
+    limiter: Optional[asyncio.Semaphore],
     ingestor: Ingestor,
     interval=5,
     timeout_ms=900,
 ):
     await asyncio.sleep(random.uniform(0, min(0.5, interval / 4)))  # jitter
+    jitter_scale = min(0.25, interval * 0.05)
+    # precomputed cadence jitter; local so only per-office tasks pay for one
+    jitter = jitter_table()
+    jitter_idx = 0
     while True:
         loop_start = time.monotonic()
 
-        gw_task = asyncio.create_task(
-            limited_ping(office.gateway_ip, limiter, timeout_ms)
-        )
-        mx_task = asyncio.create_task(limited_ping(office.mx_ip, limiter, timeout_ms))
-        ipsec_task = asyncio.create_task(
-            limited_ping(office.tunnel_probe_ip, limiter, timeout_ms)
+        # gather schedules the three pings concurrently on its own
+        gw, mx, ipsec = await asyncio.gather(
+            limited_ping(office._gw_addr, limiter, timeout_ms),
+            limited_ping(office._mx_addr, limiter, timeout_ms),
+            limited_ping(office._tunnel_addr, limiter, timeout_ms),
         )
-        gw, mx, ipsec = await asyncio.gather(gw_task, mx_task, ipsec_task)
 
-        new_state = instant_state(gw, mx, ipsec)
-
-        # debounce (unchanged)
-        changed = False
-        if new_state == office.state:
-            office._ok_streak += 1
-            office._fail_streak = 0
-        elif new_state in {"down", "degraded"} and office.state in {"up", "unknown"}:
-            office._fail_streak += 1
-            if office._fail_streak >= office.retries_down:
-                office.state = new_state
-                office._fail_streak = 0
-                office._ok_streak = 0
-                office.last_change = time.time()
-                changed = True
-        else:
-            office._ok_streak += 1
-            if office._ok_streak >= office.retries_up:
-                office.state = new_state
-                office._ok_streak = 0
-                office._fail_streak = 0
-                office.last_change = time.time()
-                changed = True
-
-        office.last_sample = {
-            "gateway": gw,
-            "mx": mx,
-            "ipsec": ipsec,
-            "ts": int(time.time()),
-        }
-
-        if changed:
-            # print for logs
-            print(
-                json.dumps(
-                    {
-                        "event": "state_change",
-                        "office": office.name,
-                        "state": office.state,
-                        "sample": office.last_sample,
-                        "at": int(office.last_change),
-                    }
-                )
-            )
-            # NEW: ingest state_change
-            await ingestor.post_json(
-                "/ingest/state_change",
-                {
-                    "office": office.name,
-                    "state": office.state,
-                    "sample": office.last_sample,
-                    "at": int(office.last_change),
-                },
-            )
+        if observe(office, gw, mx, ipsec):
+            await report_state_change(office, ingestor)
 
         # steady cadence
         elapsed = time.monotonic() - loop_start
         next_sleep = max(0.0, interval - elapsed)
-        next_sleep += random.uniform(0, min(0.25, interval * 0.05))
+        next_sleep += jitter[jitter_idx & (JITTER_TABLE_SIZE - 1)] * jitter_scale
+        jitter_idx += 1
         await asyncio.sleep(next_sleep)
 
 
 async def oneshot(
-    offices: List[Office], limiter: asyncio.Semaphore, timeout_ms: int = 900
+    offices: List[Office],
+    limiter: Optional[asyncio.Semaphore],
+    timeout_ms: int = 900,
 ):
     async def probe_single(o: Office):
-        gw_task = asyncio.create_task(limited_ping(o.gateway_ip, limiter, timeout_ms))
-        mx_task = asyncio.create_task(limited_ping(o.mx_ip, limiter, timeout_ms))
-        ipsec_task = asyncio.create_task(
-            limited_ping(o.tunnel_probe_ip, limiter, timeout_ms)
+        gw, mx, ipsec = await asyncio.gather(
+            limited_ping(o._gw_addr, limiter, timeout_ms),
+            limited_ping(o._mx_addr, limiter, timeout_ms),
+            limited_ping(o._tunnel_addr, limiter, timeout_ms),
         )
-        gw, mx, ipsec = await asyncio.gather(gw_task, mx_task, ipsec_task)
         state = instant_state(gw, mx, ipsec)
         sample = {"gateway": gw, "mx": mx, "ipsec": ipsec, "ts": int(time.time())}
         return {"office": o.name, "state": state, **sample}
 
-    results = await asyncio.gather(*(probe_single(o) for o in offices))
-    print(json.dumps({"event": "oneshot", "status": results}, separators=(",", ":")))
+    if can_batch():
+        ts = int(time.time())
+        results = [
+            {
+                "office": o.name,
+                "state": instant_state(gw, mx, ipsec),
+                "gateway": gw,
+                "mx": mx,
+                "ipsec": ipsec,
+                "ts": ts,
+            }
+            for o, gw, mx, ipsec in await batch_probe(offices, timeout_ms, limiter)
+        ]
+    else:
+        results = await asyncio.gather(*(probe_single(o) for o in offices))
+    emit({"event": "oneshot", "status": results})
 
 
-async def watch_offices_yaml(path: str, mgr: OfficeManager, poll_sec: int = 5):
-    p = Path(path)
-    last_mtime: Optional[float] = None
+async def poll_offices_yaml(path: str, mgr: OfficeManager, poll_sec: int = 5):
+    last_fp: Optional[Tuple[int, int]] = None
     while True:
         with contextlib.suppress(FileNotFoundError):
-            mtime = p.stat().st_mtime
-            if last_mtime is None or mtime > last_mtime:
+            fp = config_fingerprint(path)
+            if fp != last_fp:
                 cfg = load_yaml_config(path)
                 await mgr.reconcile(cfg)
-                last_mtime = mtime
+                last_fp = fp
         await asyncio.sleep(poll_sec)
 
 
+async def watch_offices_yaml(path: str, mgr: OfficeManager, poll_sec: int = 5):
+    if awatch is None or os.environ.get("WATCH_POLL") == "1":
+        await poll_offices_yaml(path, mgr, poll_sec=poll_sec)
+        return
+
+    p = Path(path).resolve()
+    last_fp: Optional[Tuple[int, int]] = None
+
+    async def reload():
+        nonlocal last_fp
+        with contextlib.suppress(FileNotFoundError):
+            # several events for one save (e.g. write then rename) only
+            # reconcile once
+            fp = config_fingerprint(path)
+            if fp != last_fp:
+                await mgr.reconcile(load_yaml_config(path))
+                last_fp = fp
+
+    # Watch the directory to catch editors that write-then-rename, and the file
+    # itself for in-place writes that arrive through a single-file bind mount.
+    targets = [p.parent] + ([p] if p.exists() else [])
+    await reload()
+    # debounce=200 coalesces an editor's burst of events into one reconcile;
+    # recursive=False keeps a config at the repo root from watching the tree
+    async for changes in awatch(*targets, debounce=200, recursive=False):
+        if any(Path(changed).name == p.name for _, changed in changes):
+            await reload()
+
+
 async def run(
     interval_seconds: Optional[int],
     timeout_ms: Optional[int],
@@ -367,83 +903,88 @@ async def run(
         else int(os.environ.get("PING_CONCURRENCY", "20"))
     )
 
-    limiter = asyncio.Semaphore(ping_concurrency)
-
     if once:
         offices = [Office(**o) for o in base_cfg.get("offices", [])]
+        limiter = pick_limiter(ping_concurrency, len(offices))
+        await asyncio.gather(*(resolve_office(o) for o in offices))
         await oneshot(offices, limiter=limiter, timeout_ms=timeout_ms)
         return
 
     async with Ingestor(API_BASE) as ingestor:
-        # Use the OfficeManager so YAML changes are respected
-        mgr = OfficeManager(
-            limiter=limiter, ingestor=ingestor, interval=interval, timeout_ms=timeout_ms
-        )
-
-        # Initial seed + start probe tasks (also upserts offices to the API)
-        await mgr.reconcile(base_cfg)
-
-        stop_event = asyncio.Event()
+        try:
+            # every task below (probes included) belongs to this group: one
+            # failing or a stop request cancels the rest
+            async with asyncio.TaskGroup() as tg:
+                # Use the OfficeManager so YAML changes are respected
+                mgr = OfficeManager(
+                    limiter=None,
+                    ingestor=ingestor,
+                    interval=interval,
+                    timeout_ms=timeout_ms,
+                    task_group=tg,
+                    ping_concurrency=ping_concurrency,
+                )
 
-        async def ticker():
-            interval_s = base_cfg.get("broadcast_seconds", 15)
-            try:
-                while not stop_event.is_set():
-                    summary: List[dict] = []
-                    samples_ready = True
-                    for o in mgr.list_offices():
-                        record = {"office": o.name, "state": o.state}
-                        if all(k in o.last_sample for k in ("gateway", "mx", "ipsec", "ts")):
-                            record.update(o.last_sample)
+                # Initial seed + start probe tasks (also upserts offices to the API)
+                await mgr.reconcile(base_cfg)
+
+                async def ticker():
+                    interval_s = base_cfg.get("broadcast_seconds", 15)
+                    # ticks where nothing changed are skipped, but every Nth is
+                    # sent anyway so the API's latest samples stay fresh
+                    full_every = max(1, int(base_cfg.get("full_tick_every", 4)))
+                    n = 0
+                    while True:
+                        offices = mgr.list_offices()
+                        force = n % full_every == 0
+                        n += 1
+                        if not force and not any(o._dirty for o in offices):
+                            await asyncio.sleep(interval_s)
+                            continue
+
+                        # observe() keeps each office's entry current, so a tick
+                        # is just the list of them, serialized once
+                        summary = [o._tick_dict for o in offices]
+                        samples_ready = all("ts" in record for record in summary)
+                        body = orjson.dumps(summary)
+                        emit_line(b'{"event":"tick","status":' + body + b"}")
+
+                        if samples_ready:
+                            # clear before the await so changes observed while
+                            # the POST is in flight make the next tick dirty
+                            for o in offices:
+                                o._dirty = False
+                            try:
+                                await ingestor.post_json(
+                                    "/ingest/tick", summary, raw=body
+                                )
+                            except BaseException:
+                                for o in offices:
+                                    o._dirty = True
+                                raise
                         else:
-                            samples_ready = False
-                        summary.append(record)
-                    print(json.dumps({"event": "tick", "status": summary}))
-                    
-                    if samples_ready:
-                        await ingestor.post_json("/ingest/tick", summary)
-                    else:
-                        logger.debug(
-                            "Skipping tick ingest until all offices have an initial sample"
-                        )
-                    # wait until either stop is set or the interval expires
-                    with contextlib.suppress(asyncio.TimeoutError):
-                        await asyncio.wait_for(stop_event.wait(), timeout=interval_s)
-            except asyncio.CancelledError:
-                return  # graceful shutdown
-
-        # Kick off background tasks
-        bg_tasks = [
-            asyncio.create_task(ticker()),
-            asyncio.create_task(watch_offices_yaml(config_path, mgr, poll_sec=5)),
-        ]
+                            logger.debug(
+                                "Skipping tick ingest until all offices have an "
+                                "initial sample"
+                            )
+                        await asyncio.sleep(interval_s)
 
-        # Optional bounded mode: stop after N ticks
-        if iterations and iterations > 0:
+                # Kick off background tasks
+                tg.create_task(ticker())
+                tg.create_task(watch_offices_yaml(config_path, mgr, poll_sec=5))
+                tg.create_task(mgr.refresh_dns(base_cfg.get("dns_ttl", 300)))
 
-            async def stop_after_n():
-                for _ in range(iterations):
-                    await asyncio.sleep(base_cfg.get("broadcast_seconds", 15))
-                stop_event.set()
-                await asyncio.sleep(0.1)
-                # cancel probe tasks and background tasks
-                for t in list(mgr.tasks.values()):
-                    t.cancel()
-                for t in bg_tasks:
-                    t.cancel()
+                # Optional bounded mode: stop after N ticks
+                if iterations and iterations > 0:
 
-            bg_tasks.append(asyncio.create_task(stop_after_n()))
+                    async def stop_after_n():
+                        for _ in range(iterations):
+                            await asyncio.sleep(base_cfg.get("broadcast_seconds", 15))
+                        raise StopMonitor
 
-        try:
-            # Wait on both probe tasks created by the manager and our background tasks
-            await asyncio.gather(*bg_tasks, *mgr.tasks.values())
-        except asyncio.CancelledError:
-            for t in list(mgr.tasks.values()):
-                t.cancel()
-            for t in bg_tasks:
-                t.cancel()
-            with contextlib.suppress(Exception):
-                await asyncio.gather(*mgr.tasks.values(), *bg_tasks)
+                    tg.create_task(stop_after_n())
+        except* StopMonitor:
+            pass
 
 
 def parse_args():
@@ -477,17 +1018,21 @@ def parse_args():
 
 def main():
     args = parse_args()
-    with contextlib.suppress(KeyboardInterrupt):
-        asyncio.run(
-            run(
-                interval_seconds=args.interval_seconds,
-                timeout_ms=args.timeout_ms,
-                ping_concurrency=args.ping_concurrency,
-                config_path=args.config,
-                iterations=args.iterations,
-                once=args.once,
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(
+                run(
+                    interval_seconds=args.interval_seconds,
+                    timeout_ms=args.timeout_ms,
+                    ping_concurrency=args.ping_concurrency,
+                    config_path=args.config,
+                    iterations=args.iterations,
+                    once=args.once,
+                )
             )
-        )
+    finally:
+        # don't lose queued lines (e.g. the --once result) on exit
+        flush_log()
 
 
 if __name__ == "__main__":
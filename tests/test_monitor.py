@@ -59,9 +59,11 @@ def test_reconcile_updates_retry_thresholds(monkeypatch):
         await mgr.reconcile(initial)
 
         assert mgr.offices["HQ"].retries_down == 3
+        assert calls[-1][0] == "/offices"
+        assert len(calls[-1][1]) == 1
         assert mgr.offices["HQ"].retries_up == 2
-        assert calls[-1][1]["retries_down"] == 3
-        assert calls[-1][1]["retries_up"] == 2
+        assert calls[-1][1][0]["retries_down"] == 3
+        assert calls[-1][1][0]["retries_up"] == 2
 
         updated = {
             "offices": [
@@ -79,8 +81,8 @@ def test_reconcile_updates_retry_thresholds(monkeypatch):
 
         assert mgr.offices["HQ"].retries_down == 5
         assert mgr.offices["HQ"].retries_up == 4
-        assert calls[-1][1]["retries_down"] == 5
-        assert calls[-1][1]["retries_up"] == 4
+        assert calls[-1][1][0]["retries_down"] == 5
+        assert calls[-1][1][0]["retries_up"] == 4
 
     asyncio.run(run_test())
 
@@ -163,3 +165,591 @@ async def test_ingestor_post_json_logs_and_raises_without_session(monkeypatch, c
     assert "Remote" in log_text
     assert "/offices" in log_text
     assert "attempt=2" in log_text
+
+
+def test_batch_ping_parses_fping_summary(monkeypatch):
+    seen = {}
+
+    class FakeProc:
+        async def communicate(self):
+            return b"", (
+                b"1.1.1.1 : 12.34\n"
+                b"2.2.2.2 : -\n"
+                b"nosuch.example: Name or service not known\n"
+            )
+
+    async def fake_exec(*argv, **kwargs):
+        seen["argv"] = argv
+        return FakeProc()
+
+    monkeypatch.setattr(monitor, "FPING", "/usr/bin/fping")
+    monkeypatch.setattr(monitor, "_icmp_sockets", False)
+    monkeypatch.setattr(monitor.asyncio, "create_subprocess_exec", fake_exec)
+
+    result = asyncio.run(
+        monitor.batch_ping(["1.1.1.1", "2.2.2.2", "1.1.1.1", "nosuch.example"], 500)
+    )
+
+    assert result == {"1.1.1.1": True, "2.2.2.2": False, "nosuch.example": False}
+    # duplicate targets are only pinged once
+    assert seen["argv"].count("1.1.1.1") == 1
+    assert "-t500" in seen["argv"]
+    assert "-i1" in seen["argv"]
+
+
+def test_emit_writes_lines_from_writer_thread(monkeypatch):
+    import io
+
+    class FakeStdout:
+        buffer = io.BytesIO()
+
+    monkeypatch.setattr(monitor.sys, "stdout", FakeStdout)
+
+    monitor.emit({"event": "tick", "status": []})
+    monitor.emit({"event": "oneshot", "status": [{"office": "HQ"}]})
+    monitor.flush_log()
+
+    assert FakeStdout.buffer.getvalue().splitlines() == [
+        b'{"event":"tick","status":[]}',
+        b'{"event":"oneshot","status":[{"office":"HQ"}]}',
+    ]
+
+
+def test_office_caches_payload_and_tick_entry():
+    o = monitor.Office(
+        name="HQ", gateway_ip="1.1.1.1", mx_ip="2.2.2.2", tunnel_probe_ip="3.3.3.3"
+    )
+    assert monitor.orjson.loads(o._office_json) == o._office_payload
+    assert o._tick_dict == {"office": "HQ", "state": "unknown"}
+
+    tick = o._tick_dict
+    monitor.observe(o, True, True, False)
+    assert o._tick_dict is tick
+    assert tick["state"] == o.state
+    assert {k: tick[k] for k in ("gateway", "mx", "ipsec")} == {
+        "gateway": True,
+        "mx": True,
+        "ipsec": False,
+    }
+
+    o.gateway_ip = "9.9.9.9"
+    o.refresh_payload()
+    assert monitor.orjson.loads(o._office_json)["gateway_ip"] == "9.9.9.9"
+
+
+def test_observe_timer_debounce(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(monitor.time, "monotonic", lambda: now[0])
+
+    o = monitor.Office(
+        name="HQ",
+        gateway_ip="1.1.1.1",
+        mx_ip="2.2.2.2",
+        tunnel_probe_ip="3.3.3.3",
+        state="up",
+        debounce_ms=3000,
+    )
+
+    assert monitor.observe(o, False, False, False) is False
+    now[0] += 2
+    assert monitor.observe(o, False, False, False) is False
+    # a flap back to the committed state cancels the pending change
+    now[0] += 0.5
+    assert monitor.observe(o, True, True, True) is False
+    now[0] += 1
+    assert monitor.observe(o, False, False, False) is False
+    now[0] += 3
+    assert monitor.observe(o, False, False, False) is True
+    assert o.state == "down"
+
+
+def test_resolve_office_caches_ipv4_targets(monkeypatch):
+    looked_up = []
+    failing = {"missing.example"}
+
+    async def fake_getaddrinfo(host, port, family=0, type=0):
+        looked_up.append(host)
+        if host in failing:
+            raise monitor.socket.gaierror("not found")
+        return [(family, type, 17, "", ("10.0.0.7", 0))]
+
+    async def run_test():
+        monkeypatch.setattr(
+            asyncio.get_running_loop(), "getaddrinfo", fake_getaddrinfo
+        )
+        o = monitor.Office(
+            name="HQ",
+            gateway_ip="gw.example",
+            mx_ip="2.2.2.2",
+            tunnel_probe_ip="missing.example",
+        )
+        await monitor.resolve_office(o)
+        first = (o._gw_addr, o._mx_addr, o._tunnel_addr)
+        # a failed refresh keeps the last good address
+        failing.add("gw.example")
+        await monitor.resolve_office(o)
+        return first, (o._gw_addr, o._mx_addr, o._tunnel_addr)
+
+    first, refreshed = asyncio.run(run_test())
+
+    assert first == ("10.0.0.7", "2.2.2.2", "missing.example")
+    assert refreshed == first
+    # IP literals are never looked up
+    assert sorted(looked_up) == [
+        "gw.example",
+        "gw.example",
+        "missing.example",
+        "missing.example",
+    ]
+
+
+def test_reconcile_publishes_offices_after_resolve_and_upsert(monkeypatch):
+    events = []
+    addrs = {"gw.example": "10.0.0.7", "gw2.example": "10.0.0.8"}
+
+    class DummyIngestor:
+        async def post_json(self, path, payload, **kwargs):
+            events.append(path)
+
+    async def slow_getaddrinfo(host, port, family=0, type=0):
+        await asyncio.sleep(0.05)
+        return [(family, type, 17, "", (addrs[host], 0))]
+
+    async def fake_batch_probe(offices, timeout_ms, limiter=None):
+        events.append([o._gw_addr for o in offices])
+        return [(o, True, True, True) for o in offices]
+
+    monkeypatch.setattr(monitor, "batch_probe", fake_batch_probe)
+
+    async def run_test():
+        monkeypatch.setattr(
+            asyncio.get_running_loop(), "getaddrinfo", slow_getaddrinfo
+        )
+        mgr = monitor.OfficeManager(
+            None, DummyIngestor(), interval=0.01, timeout_ms=1
+        )
+        mgr.batch = True
+        rec = {
+            "name": "HQ",
+            "gateway_ip": "gw.example",
+            "mx_ip": "2.2.2.2",
+            "tunnel_probe_ip": "3.3.3.3",
+        }
+        await mgr.reconcile({"offices": [rec]})
+        await asyncio.sleep(0.05)
+        # while the new address resolves, the loop keeps the old one
+        reconcile = asyncio.create_task(
+            mgr.reconcile({"offices": [dict(rec, gateway_ip="gw2.example")]})
+        )
+        await asyncio.sleep(0.02)
+        during = mgr.offices["HQ"]._gw_addr
+        await reconcile
+        after = mgr.offices["HQ"]._gw_addr
+        mgr._batch_task.cancel()
+        await asyncio.gather(mgr._batch_task, return_exceptions=True)
+        return during, after
+
+    during, after = asyncio.run(run_test())
+
+    assert (during, after) == ("10.0.0.7", "10.0.0.8")
+    # nothing was probed before the office was resolved and stored
+    assert events[0] == "/offices"
+    assert all(e != ["gw.example"] for e in events)
+
+
+def test_load_yaml_config_reuses_unchanged_parse(tmp_path):
+    import os
+
+    cfg_path = tmp_path / "offices.yaml"
+    cfg_path.write_text("interval_seconds: 5\n")
+
+    first = monitor.load_yaml_config(str(cfg_path))
+    assert first == {"interval_seconds": 5}
+    assert monitor.load_yaml_config(str(cfg_path)) is first
+
+    cfg_path.write_text("interval_seconds: 10\n")
+    st = cfg_path.stat()
+    os.utime(cfg_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert monitor.load_yaml_config(str(cfg_path)) == {"interval_seconds": 10}
+
+
+def test_batch_ping_falls_back_when_icmp_sockets_denied(monkeypatch):
+    import types
+
+    class ICMPLibError(Exception):
+        pass
+
+    class SocketPermissionError(ICMPLibError):
+        pass
+
+    calls = []
+
+    async def async_multiping(hosts, **kwargs):
+        calls.append((hosts, kwargs))
+        if len(calls) == 1:
+            return [types.SimpleNamespace(is_alive=h == "1.1.1.1") for h in hosts]
+        raise SocketPermissionError("denied")
+
+    class ICMPv4Socket:
+        def __init__(self, privileged=True):
+            if sockets_denied:
+                raise SocketPermissionError("denied")
+
+        def close(self):
+            pass
+
+    sockets_denied = False
+    fake = types.SimpleNamespace(
+        async_multiping=async_multiping,
+        ICMPv4Socket=ICMPv4Socket,
+        ICMPLibError=ICMPLibError,
+        SocketPermissionError=SocketPermissionError,
+    )
+
+    async def fake_fping(hosts, timeout_ms):
+        return dict.fromkeys(hosts, True)
+
+    monkeypatch.setattr(monitor, "icmplib", fake)
+    monkeypatch.setattr(monitor, "_icmp_sockets", True)
+    monkeypatch.setattr(monitor, "_icmp_checked", False)
+    monkeypatch.setattr(monitor, "FPING", "/usr/bin/fping")
+    monkeypatch.setattr(monitor, "_fping_many", fake_fping)
+
+    assert asyncio.run(
+        monitor.batch_ping(["1.1.1.1", "2.2.2.2", "nosuch.example"], 500)
+    ) == {"1.1.1.1": True, "2.2.2.2": False, "nosuch.example": False}
+    # unresolved names never reach icmplib, where one would fail the batch
+    assert calls[0][0] == ["1.1.1.1", "2.2.2.2"]
+    assert calls[0][1]["privileged"] is False
+    assert calls[0][1]["count"] == 1
+
+    hosts = ["1.1.1.1", "2.2.2.2"]
+    # a permission error switches to fping for good
+    assert asyncio.run(monitor.batch_ping(hosts, 500)) == dict.fromkeys(hosts, True)
+    assert monitor._icmp_sockets is False
+    asyncio.run(monitor.batch_ping(hosts, 500))
+    assert len(calls) == 2
+
+    # a socket check that fails up front never starts a batch
+    sockets_denied = True
+    calls.clear()
+    monkeypatch.setattr(monitor, "_icmp_sockets", True)
+    monkeypatch.setattr(monitor, "_icmp_checked", False)
+    assert asyncio.run(monitor.batch_ping(hosts, 500)) == dict.fromkeys(hosts, True)
+    assert calls == []
+    assert monitor._icmp_sockets is False
+
+
+def test_icmplib_batch_caps_sockets_and_falls_back_on_oserror(monkeypatch):
+    import errno
+    import types
+
+    class ICMPLibError(Exception):
+        pass
+
+    calls = []
+
+    async def async_multiping(hosts, **kwargs):
+        calls.append(kwargs["concurrent_tasks"])
+        raise OSError(errno.EMFILE, "Too many open files")
+
+    fake = types.SimpleNamespace(
+        async_multiping=async_multiping,
+        ICMPLibError=ICMPLibError,
+        SocketPermissionError=type("SocketPermissionError", (ICMPLibError,), {}),
+    )
+
+    async def fake_fping(hosts, timeout_ms):
+        return dict.fromkeys(hosts, True)
+
+    monkeypatch.setattr(monitor, "icmplib", fake)
+    monkeypatch.setattr(monitor, "_icmp_sockets", True)
+    monkeypatch.setattr(monitor, "_icmp_checked", True)
+    monkeypatch.setattr(monitor, "ICMP_CONCURRENCY", 4)
+    monkeypatch.setattr(monitor, "FPING", "/usr/bin/fping")
+    monkeypatch.setattr(monitor, "_fping_many", fake_fping)
+
+    hosts = [f"10.0.0.{i}" for i in range(10)]
+    assert asyncio.run(monitor.batch_ping(hosts, 500)) == dict.fromkeys(hosts, True)
+    assert calls == [4]
+    # running out of descriptors is transient: icmplib is tried again next batch
+    assert monitor._icmp_sockets is True
+
+
+def test_observe_marks_office_dirty_only_on_change():
+    o = monitor.Office(
+        name="HQ", gateway_ip="1.1.1.1", mx_ip="2.2.2.2", tunnel_probe_ip="3.3.3.3"
+    )
+    assert o._dirty is True
+
+    monitor.observe(o, True, True, True)
+    o._dirty = False
+    monitor.observe(o, True, True, True)
+    assert o._dirty is False
+
+    # reachability changed, even though the debounced state has not yet
+    monitor.observe(o, True, True, False)
+    assert o.state == "up"
+    assert o._dirty is True
+
+
+def test_probe_all_offices_does_not_wait_for_reports(monkeypatch):
+    cycles = []
+    posts = []
+
+    class StalledIngestor:
+        async def post_json(self, path, payload, **kwargs):
+            posts.append(payload["state"])
+            await asyncio.Event().wait()  # the API never answers
+
+    async def fake_batch_probe(offices, timeout_ms, limiter=None):
+        cycles.append(len(offices))
+        up = len(cycles) % 2 == 1
+        return [(o, up, up, up) for o in offices]
+
+    monkeypatch.setattr(monitor, "batch_probe", fake_batch_probe)
+    monkeypatch.setattr(monitor, "emit", lambda record: None)
+
+    async def run_test():
+        mgr = monitor.OfficeManager(
+            None, StalledIngestor(), interval=0.01, timeout_ms=1
+        )
+        mgr.offices["HQ"] = monitor.Office(
+            name="HQ",
+            gateway_ip="1.1.1.1",
+            mx_ip="2.2.2.2",
+            tunnel_probe_ip="3.3.3.3",
+            retries_down=1,
+        )
+        task = asyncio.create_task(mgr.probe_all_offices())
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # let reports spawned by the last cycle reach their POST
+        await asyncio.sleep(0)
+        pending = len(mgr._reports)
+        for t in list(mgr._reports):
+            t.cancel()
+        await asyncio.gather(*mgr._reports, return_exceptions=True)
+        return pending
+
+    pending = asyncio.run(run_test())
+
+    # probing kept its cadence while every report was stuck in flight
+    assert len(cycles) >= 4
+    assert pending == len(posts) >= 3
+
+
+def _offices_cfg(n):
+    return {
+        "offices": [
+            {
+                "name": f"o{i}",
+                "gateway_ip": f"10.0.0.{i}",
+                "mx_ip": f"10.0.1.{i}",
+                "tunnel_probe_ip": f"10.0.2.{i}",
+            }
+            for i in range(n)
+        ]
+    }
+
+
+def test_reconcile_rechecks_ping_limiter(monkeypatch):
+    started = []
+
+    class DummyIngestor:
+        async def post_json(self, path, payload, **kwargs):
+            pass
+
+    async def fake_probe(office, limiter, *args):
+        started.append((office.name, limiter))
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(monitor, "probe_office", fake_probe)
+
+    async def run_test():
+        mgr = monitor.OfficeManager(
+            None, DummyIngestor(), interval=1, timeout_ms=100, ping_concurrency=6
+        )
+        mgr.batch = False
+        await mgr.reconcile(_offices_cfg(2))
+        await asyncio.sleep(0)
+        assert mgr.limiter is None
+        assert all(limiter is None for _, limiter in started)
+
+        # three offices need nine pings: the cap applies again, also to the
+        # probes that were already running
+        started.clear()
+        await mgr.reconcile(_offices_cfg(3))
+        await asyncio.sleep(0)
+        assert isinstance(mgr.limiter, asyncio.BoundedSemaphore)
+        assert sorted(name for name, _ in started) == ["o0", "o1", "o2"]
+        assert all(limiter is mgr.limiter for _, limiter in started)
+
+        for t in mgr.tasks.values():
+            t.cancel()
+        await asyncio.gather(*mgr.tasks.values(), return_exceptions=True)
+
+    asyncio.run(run_test())
+
+
+def test_batch_ping_ping3_fallback_honours_limiter(monkeypatch):
+    active = [0]
+    peak = [0]
+
+    async def fake_ping_host(host, timeout_ms=900):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        return True
+
+    monkeypatch.setattr(monitor, "_icmp_sockets", False)
+    monkeypatch.setattr(monitor, "FPING", None)
+    monkeypatch.setattr(monitor, "ping_host", fake_ping_host)
+
+    async def run_test():
+        hosts = [f"10.0.0.{i}" for i in range(6)]
+        return await monitor.batch_ping(hosts, 100, asyncio.BoundedSemaphore(2))
+
+    assert all(asyncio.run(run_test()).values())
+    assert peak[0] == 2
+
+
+class RecordingManager:
+    def __init__(self):
+        self.configs = []
+        self.changed = asyncio.Event()
+
+    async def reconcile(self, cfg):
+        self.configs.append(cfg)
+        self.changed.set()
+
+
+async def _wait_for_reconcile(mgr, count, timeout=5.0):
+    async def wait():
+        while len(mgr.configs) < count:
+            mgr.changed.clear()
+            await mgr.changed.wait()
+
+    await asyncio.wait_for(wait(), timeout)
+
+
+def test_watch_offices_yaml_reconciles_once_per_edit(monkeypatch, tmp_path):
+    if monitor.awatch is None:
+        pytest.skip("watchfiles not installed")
+    monkeypatch.delenv("WATCH_POLL", raising=False)
+    cfg_path = tmp_path / "offices.yaml"
+    cfg_path.write_text("offices: []\n")
+
+    async def run_test():
+        mgr = RecordingManager()
+        task = asyncio.create_task(monitor.watch_offices_yaml(str(cfg_path), mgr))
+        try:
+            await _wait_for_reconcile(mgr, 1)
+            # give the watcher time to start before editing
+            await asyncio.sleep(0.3)
+            cfg_path.write_text("offices:\n  - name: HQ\n")
+            await _wait_for_reconcile(mgr, 2)
+            # the editor's burst of events must not reconcile again
+            await asyncio.sleep(0.6)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return mgr.configs
+
+    configs = asyncio.run(run_test())
+
+    assert configs == [{"offices": []}, {"offices": [{"name": "HQ"}]}]
+
+
+def test_watch_offices_yaml_polling_fallback(monkeypatch, tmp_path):
+    import os
+
+    monkeypatch.setenv("WATCH_POLL", "1")
+    cfg_path = tmp_path / "offices.yaml"
+    cfg_path.write_text("offices: []\n")
+
+    async def run_test():
+        mgr = RecordingManager()
+        task = asyncio.create_task(
+            monitor.watch_offices_yaml(str(cfg_path), mgr, poll_sec=0.02)
+        )
+        try:
+            await _wait_for_reconcile(mgr, 1)
+            # unchanged file: further polls don't reconcile
+            await asyncio.sleep(0.1)
+            assert len(mgr.configs) == 1
+
+            cfg_path.write_text("offices:\n  - name: HQ\n")
+            st = cfg_path.stat()
+            os.utime(cfg_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+            await _wait_for_reconcile(mgr, 2)
+            await asyncio.sleep(0.1)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return mgr.configs
+
+    configs = asyncio.run(run_test())
+
+    assert configs == [{"offices": []}, {"offices": [{"name": "HQ"}]}]
+
+
+def test_run_iterations_exits_cleanly(monkeypatch, tmp_path):
+    posted = []
+
+    class StubIngestor:
+        def __init__(self, base):
+            self.base = base
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            return None
+
+        async def post_json(self, path, payload, **kwargs):
+            posted.append(path)
+
+    async def fake_batch_ping(hosts, timeout_ms=900, limiter=None):
+        return dict.fromkeys(hosts, True)
+
+    monkeypatch.setattr(monitor, "Ingestor", StubIngestor)
+    monkeypatch.setattr(monitor, "batch_ping", fake_batch_ping)
+    monkeypatch.setattr(monitor, "can_batch", lambda: True)
+    monkeypatch.setattr(monitor, "emit_line", lambda line: None)
+    monkeypatch.setattr(monitor, "emit", lambda record: None)
+    monkeypatch.setenv("WATCH_POLL", "1")
+    cfg_path = tmp_path / "offices.yaml"
+    cfg_path.write_text(
+        "broadcast_seconds: 0.05\n"
+        "full_tick_every: 1\n"
+        "offices:\n"
+        "  - name: HQ\n"
+        "    gateway_ip: 10.0.0.1\n"
+        "    mx_ip: 10.0.0.2\n"
+        "    tunnel_probe_ip: 10.0.0.3\n"
+    )
+
+    async def run_test():
+        await asyncio.wait_for(
+            monitor.run(
+                interval_seconds=0.01,
+                timeout_ms=10,
+                ping_concurrency=10,
+                config_path=str(cfg_path),
+                iterations=3,
+                once=False,
+            ),
+            timeout=5,
+        )
+        return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    pending = asyncio.run(run_test())
+
+    assert pending == []
+    # the office is stored before its first state change or tick is sent
+    assert posted[0] == "/offices"
+    assert "/ingest/state_change" in posted[1:]
+    assert "/ingest/tick" in posted